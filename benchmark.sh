@@ -0,0 +1 @@
+python -m c4.benchmark "$@"
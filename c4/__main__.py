@@ -1,27 +1,127 @@
+import argparse
+import os
 import sys
 from . import parser
+from . import profile
+from . import transformer
+from . import unity
 
 MODULE_BANNER = "/* THIS FILE WAS AUTOGENERATED FROM %s USING THE C4 TRANSPILER */\n"
 
 
-def Translate(string, source):
-  return MODULE_BANNER % source + parser.Parse(string, source).str
+def Translate(string, source, passes=(), report=None):
+  # Templates and struct-of-arrays types have to be expanded before code can be generated, so the language passes always run first.
+  # If report is a file, the time spent in every pass is written to it.
+  module = parser.Parse(string, source)
+  manager = transformer.PassManager(transformer.LanguagePasses() + list(passes), time_visitors=report is not None)
+  module = manager.Run(module)
+  if report is not None:
+    report.write(manager.Report())
+  return MODULE_BANNER % source + manager.Prologue() + module.str
+
+
+def TranslateStream(stream, source, out, passes=(), report=None):
+  # Like Translate, but reads the program from a file-like stream, and writes each top-level statement to out as soon as it is translated.
+  # Memory use is bounded by the largest top-level statement rather than by the size of the program.
+  # Unlike with Translate, templates defined in the program must be defined before they are used.
+  manager = transformer.PassManager(transformer.LanguagePasses() + list(passes), time_visitors=report is not None)
+  out.write(MODULE_BANNER % source + manager.Prologue())
+  statements = parser.Parser('', source, stream).Statements()
+  for stmt in manager.Stream(statements):
+    out.write(stmt.Str(0))
+  if report is not None:
+    report.write(manager.Report())
+
+
+def PositiveInt(string):
+  value = int(string)
+  if value < 1:
+    raise argparse.ArgumentTypeError('must be at least 1, not %d' % value)
+  return value
+
+
+def WriteFile(path, text):
+  with open(path, 'w') as f:
+    f.write(text)
 
 
 def main():
-  if len(sys.argv) == 1:
+  argparser = argparse.ArgumentParser(prog='python -m c4', description='Translate a c4 program to C, and write the C to stdout.')
+  argparser.add_argument('sources', nargs='*', metavar='source', help='the .c4 file to translate (default: stdin); several with --unity')
+  layout = argparser.add_mutually_exclusive_group()
+  layout.add_argument('--reorder-struct-fields', action='store_true', help='reorder struct fields to minimize padding')
+  layout.add_argument('--warn-struct-padding', action='store_true', help='only report the bytes structs waste on padding')
+  argparser.add_argument('--target-abi', choices=sorted(transformer.TARGET_ABIS), default=transformer.X86_64_SYSV.name, help='ABI used to estimate struct layouts (default: %(default)s)')
+  argparser.add_argument('--time-passes', action='store_true', help='write the time spent in every transformer pass to stderr')
+  argparser.add_argument('--instrument', choices=sorted(transformer.INSTRUMENTATION_DUMPS), help='count the calls to every function and time them; the counts are written at exit to $C4_PROFILE (default: c4_profile.csv or c4_profile.jsonl)')
+  profile_options = argparser.add_argument_group('profile-guided optimization', 'Mark functions hot or cold according to a profile of the program (see c4/profile.py for the supported formats).')
+  profile_options.add_argument('--profile', metavar='FILE', help='c4 --instrument, gprof flat profile, gcov -b or gcov JSON output')
+  profile_options.add_argument('--hot-fraction', type=float, default=0.9, help='the most called functions that together make this fraction of all calls are hot (default: %(default)s)')
+  profile_options.add_argument('--group-hot-functions', action='store_true', help='also move hot and then cold function definitions to the end of the C file (turns off streaming)')
+  unity_options = argparser.add_argument_group('unity builds', 'Translate all the sources together into as few C files as possible (see c4/unity.py).')
+  unity_options.add_argument('--unity', action='store_true', help='translate all the sources into one C file, or into --batches files')
+  unity_options.add_argument('--batches', type=PositiveInt, default=1, help='number of C files to spread the sources over (default: %(default)s)')
+  unity_options.add_argument('--pch', metavar='HEADER', help='put the includes and declarations shared by all batches into this header (a candidate for precompiling)')
+  unity_options.add_argument('--output-dir', help='directory to write HEADER and the batches, c4_unity0.c, c4_unity1.c, ..., to (default: stdout, if there is only one batch and no HEADER)')
+  args = argparser.parse_args()
+
+  if not args.unity and len(args.sources) > 1:
+    argparser.error('translating several sources needs --unity')
+  if args.unity and not args.sources:
+    argparser.error('--unity needs the sources to translate')
+  if args.unity and args.output_dir is None and (args.batches > 1 or args.pch):
+    argparser.error('--batches and --pch need --output-dir')
+  if args.group_hot_functions and (args.unity or not args.profile):
+    argparser.error('--group-hot-functions needs --profile, and does not work with --unity')
+
+  passes = []
+  if args.reorder_struct_fields or args.warn_struct_padding:
+    reorderer = transformer.StructFieldReorderer(transformer.TARGET_ABIS[args.target_abi], reorder=args.reorder_struct_fields)
+    passes.append(reorderer)
+  if args.instrument:
+    passes.append(transformer.Instrumenter(args.instrument))
+  if args.profile:
+    try:
+      calls = profile.ReadProfile(args.profile)
+    except (profile.ProfileError, IOError) as e:
+      argparser.error(str(e))
+    passes.append(transformer.ProfileAnnotator(calls, args.hot_fraction))
+    if args.group_hot_functions:
+      passes.append(transformer.HotFunctionGrouper())
+
+  report = sys.stderr if args.time_passes else None
+  if args.unity:
+    modules = []
+    for source in args.sources:
+      with open(source) as f:
+        modules.append((source, f.read()))
+    header, units = unity.TranslateUnity(modules, passes, args.batches, args.pch, report)
+    if args.output_dir is None:
+      sys.stdout.write(units[0])
+    else:
+      if header is not None:
+        WriteFile(os.path.join(args.output_dir, args.pch), header)
+      for index, unit in enumerate(units):
+        WriteFile(os.path.join(args.output_dir, 'c4_unity%d.c' % index), unit)
+    source = ', '.join(args.sources)
+  elif args.group_hot_functions:
+    source = args.sources[0] if args.sources else '<stdin>'
+    if args.sources:
+      with open(source) as f:
+        sys.stdout.write(Translate(f.read(), source, passes, report))
+    else:
+      sys.stdout.write(Translate(sys.stdin.read(), source, passes, report))
+  elif not args.sources:
     source = '<stdin>'
-    string = sys.stdin.read()
-  elif len(sys.argv) == 2:
-    source = sys.argv[1]
-    with open(sys.argv[1]) as f:
-      string = f.read()
+    TranslateStream(sys.stdin, source, sys.stdout, passes, report)
   else:
-    print('Usage: python %s [source.c4]' % sys.argv[0])
-    exit(1)
-
-  sys.stdout.write(Translate(string, source))
+    source = args.sources[0]
+    with open(source) as f:
+      TranslateStream(f, source, sys.stdout, passes, report)
 
+  for pass_ in passes:
+    for message in getattr(pass_, 'messages', ()):
+      sys.stderr.write('%s: %s\n' % (source, message))
 
 if __name__ == '__main__':
   main()
@@ -17,6 +17,11 @@ Some nodes, like the TemplateFunctionDefinition, are removed by the transformer
 
 Not all tree nodes are generated by the parser.
 Some nodes, like FunctionDeclaration, are inserted by the transformer to make code generation easier.
+
+Generated code is memoized per node: the first time a node's 'str' or 'Str(depth)' is computed, the text is stored on the node (keyed by depth), and later calls return it without walking the subtree again.
+So re-emitting a module in which only one function changed only costs generating that one function.
+The cached code of a node also covers its descendants, but nodes do not know their ancestors, so assigning to an attribute or annotation of an existing node (e.g. function.specifiers = ...) drops every cache: the new value can't be missed, but everything is generated again.
+So the cheap way to change a node is to replace it with a modified Copy (e.g. function.Copy(body=new_body)), and to replace its ancestors the same way; a copy starts with an empty cache, while the untouched siblings keep theirs.
 """
 
 # Tab is two spaces because I says so.
@@ -32,6 +37,32 @@ def SanitizeCharacter(c):
           '\\\'' if c == '\'' else
           c)
 
+# The number of assignments to attributes and annotations of existing nodes so far. Caches made before the latest one are stale.
+_mutations = [0]
+
+
+def MemoizeStr(fget):
+  def str(self):
+    cache = self.__dict__.get('_emitted')
+    if cache is None or cache['mutations'] != _mutations[0]:
+      cache = self.__dict__['_emitted'] = {'mutations': _mutations[0]}
+    if None not in cache:
+      cache[None] = fget(self)
+    return cache[None]
+  return property(str)
+
+
+def MemoizeStrMethod(method):
+  def Str(self, depth):
+    cache = self.__dict__.get('_emitted')
+    if cache is None or cache['mutations'] != _mutations[0]:
+      cache = self.__dict__['_emitted'] = {'mutations': _mutations[0]}
+    if depth not in cache:
+      cache[depth] = method(self, depth)
+    return cache[depth]
+  return Str
+
+
 class TreeMetaclass(type):
 
   def __init__(cls, name, bases, dict_):
@@ -41,6 +72,11 @@ class TreeMetaclass(type):
       for attr in all_attributes:
         if all_attributes.count(attr) > 1:
           raise TypeError('Ast class %s has duplicate attribute/annotation %s' % (cls.__name__, attr))
+    # Memoize code generation. See the module docstring.
+    if isinstance(dict_.get('str'), property):
+      cls.str = MemoizeStr(dict_['str'].fget)
+    if 'Str' in dict_:
+      cls.Str = MemoizeStrMethod(dict_['Str'])
 
 
 class Tree(TreeMetaclass('Tree', (), dict())):
@@ -52,10 +88,18 @@ class Tree(TreeMetaclass('Tree', (), dict())):
                       (type(self).__name__,
                        len(self.attributes), self.attributes,
                        len(args), args))
+    # A node under construction has no generated code yet, so this does not go through __setattr__.
+    values = self.__dict__
     for attr, arg in zip(self.attributes, args):
-      setattr(self, attr, arg)
+      values[attr] = arg
     for annotation in self.annotations:
-      setattr(self, annotation, None)
+      values[annotation] = None
+
+  def __setattr__(self, name, value):
+    # The generated code of any ancestor may depend on the old value. See the module docstring.
+    if name in self.attributes or name in self.annotations:
+      _mutations[0] += 1
+    object.__setattr__(self, name, value)
 
   def NotImplementedError(self):
     return NotImplementedError(type(self).__name__ + ' does not implement this method')
@@ -66,10 +110,14 @@ class Tree(TreeMetaclass('Tree', (), dict())):
   def __repr__(self):
     return '%s(%s)' % (type(self).__name__, ', '.join(repr(getattr(self, attr)) for attr in self.attributes))
 
-  def Copy(self):
-    copy = type(self)(*tuple(getattr(self, attr) for attr in self.attributes))
+  def Copy(self, **changes):
+    # The copy does not share the generated code cache, so attributes may be replaced through 'changes'.
+    for attr in changes:
+      if attr not in self.attributes:
+        raise TypeError('%s has no attribute %s' % (type(self).__name__, attr))
+    copy = type(self)(*tuple(changes[attr] if attr in changes else getattr(self, attr) for attr in self.attributes))
     for annotation in self.annotations:
-      setattr(copy, annotation, getattr(self, annotation))
+      object.__setattr__(copy, annotation, getattr(self, annotation))
     return copy
 
 
@@ -209,7 +257,27 @@ class BinaryOperation(Expression):
 
   @property
   def str(self):
-    return '%s %s %s' % (self.left, self.operator, self.right)
+    # The parser builds chains like a + b + c + ... deep on the left, so the chain is emitted in one loop down its left spine instead of recursing.
+    # That way, a chain of any length can be emitted, in time linear in its length, and only the text of the whole chain is cached, not that of each prefix.
+    # Operands are never parenthesized, so this works for chains of mixed operators too.
+    parts = []
+    node = self
+    while isinstance(node, BinaryOperation):
+      parts.append(node.right.str)
+      parts.append(node.operator)
+      node = node.left
+    parts.append(node.str)
+    parts.reverse()
+    return ' '.join(parts)
+
+
+class InitializerList(Expression):
+  attributes = ('values',)
+
+  @property
+  def str(self):
+    # Inserted by the transformer, e.g. for tables computed at compile time.
+    return '{' + ', '.join(value.str for value in self.values) + '}'
 
 
 class ConditionalExpression(Expression):
@@ -239,22 +307,29 @@ class VariableDeclaration(Statement):
   def Str(self, depth):
     vdcl = TAB * depth + self.type.Declare(self.name.str)
     if self.value is not None:
-      vdcl += ' = ' + self.value.str + ';\n'
-    return vdcl
+      vdcl += ' = ' + self.value.str
+    return vdcl + ';\n'
+
+
+def Specifiers(specifiers):
+  # 'specifiers' annotations hold a tuple of extra declaration specifiers for functions (e.g. static, attribute macros) added by the transformer.
+  return ''.join(specifier + ' ' for specifier in specifiers or ())
 
 
 class FunctionDeclaration(Tree):
   attributes = ('name', 'type',)
+  annotations = Tree.annotations + ('specifiers',)
 
   def Str(self, depth):
-    return TAB * depth + self.type.Declare(self.name) + ';\n'
+    return TAB * depth + Specifiers(self.specifiers) + self.type.Declare(self.name) + ';\n'
 
 
 class FunctionDefinition(Statement):
   attributes = ('name', 'type', 'body',)
+  annotations = Statement.annotations + ('specifiers',)
 
   def Str(self, depth):
-    return TAB * depth + self.type.Declare(self.name.str) + '\n' + self.body.Str(0)
+    return TAB * depth + Specifiers(self.specifiers) + self.type.Declare(self.name.str) + '\n' + self.body.Str(0)
 
 
 class While(Statement):
@@ -264,6 +339,18 @@ class While(Statement):
     return TAB * depth + 'while (' + self.condition.str + ')\n' + self.body.Str(depth)
 
 
+class If(Statement):
+  attributes = ('condition', 'body', 'orelse',)
+
+  def Str(self, depth):
+    if_ = TAB * depth + 'if (' + self.condition.str + ')\n' + self.body.Str(depth)
+    if isinstance(self.orelse, If):
+      if_ += TAB * depth + 'else ' + self.orelse.Str(depth).lstrip()
+    elif self.orelse is not None:
+      if_ += TAB * depth + 'else\n' + self.orelse.Str(depth)
+    return if_
+
+
 class Block(Statement):
   attributes = ('statements',)
 
@@ -291,7 +378,19 @@ class StructDefinition(Statement):
   attributes = ('name', 'bases', 'body',)
 
   def Str(self, depth):
-    return TAB * depth + 'struct ' + self.name.EmptyDeclare() + '\n' + self.body.Str(depth)
+    # The typedef lets c4 code refer to the struct by its bare name (e.g. ';v p *Point;'), including from inside its own body.
+    # The body is a Block, and a struct definition needs a semicolon after its closing brace.
+    name = self.name.EmptyDeclare()
+    return (TAB * depth + 'typedef struct %s %s;\n' % (name, name) +
+            TAB * depth + 'struct ' + name + '\n' + self.body.Str(depth)[:-1] + ';\n')
+
+
+class Verbatim(Statement):
+  attributes = ('text',)
+
+  def Str(self, depth):
+    # C code inserted by the transformer as is, e.g. runtime support code.
+    return self.text
 
 
 class TemplateFunctionDefinition(Statement):
@@ -332,7 +431,7 @@ class ArrayType(Type):
   def Declare(self, declarator):
     if declarator.startswith('*'):
       declarator = '(' + declarator + ')'
-    return self.type.Declare(declarator + '[' + self.count + ']')
+    return self.type.Declare(declarator + '[' + str(self.count) + ']')
 
 
 class ConstType(Type):
@@ -14,5 +14,64 @@ class AstTest(unittest.TestCase):
         '5 + 5.0')
 
 
+class BinaryOperationTest(unittest.TestCase):
+
+  def test_mixed_operators(self):
+    expr = ast.BinaryOperation(ast.BinaryOperation(ast.Id('a'), '*', ast.Id('b')), '+', ast.ParentheticalExpression(ast.BinaryOperation(ast.Id('c'), '-', ast.Id('d'))))
+    self.assertEqual(expr.str, 'a * b + (c - d)')
+
+  def test_long_chain(self):
+    expr = ast.Int(0)
+    for i in range(1, 20000):
+      expr = ast.BinaryOperation(expr, '+', ast.Int(i % 10))
+    text = expr.str
+    self.assertEqual(len(text), len('0') + len(' + 1') * 19999)
+    self.assertTrue(text.startswith('0 + 1 + 2 + '))
+    self.assertNotIn('_emitted', expr.left.__dict__)
+
+
+class CountingId(ast.Id):
+  attributes = ('value', 'counter',)
+
+  @property
+  def str(self):
+    self.counter.append(self.value)
+    return self.value
+
+
+class EmissionCacheTest(unittest.TestCase):
+
+  def test_generated_code_is_cached(self):
+    counter = []
+    stmt = ast.ExpressionStatement(ast.FunctionCall(CountingId('f', counter), ()))
+    self.assertEqual(stmt.Str(0), 'f();\n')
+    self.assertEqual(stmt.Str(0), 'f();\n')
+    self.assertEqual(stmt.Str(1), '  f();\n')
+    self.assertEqual(counter, ['f'])
+
+  def test_copy_invalidates(self):
+    counter = []
+    unchanged = ast.ExpressionStatement(CountingId('a', counter))
+    changed = ast.Return(CountingId('b', counter))
+    module = ast.Module((unchanged, changed))
+    self.assertEqual(module.str, 'a;\nreturn b;\n')
+    module = module.Copy(statements=(unchanged, changed.Copy(expression=CountingId('c', counter))))
+    self.assertEqual(module.str, 'a;\nreturn c;\n')
+    self.assertEqual(counter, ['a', 'b', 'c'])
+
+  def test_assignment_invalidates(self):
+    number = ast.Int(1)
+    function = ast.FunctionDefinition(ast.Id('f'), ast.FunctionType((), (), ast.TypeId('int')), ast.Block((ast.Return(number),)))
+    module = ast.Module((function,))
+    self.assertEqual(module.str, 'int f()\n{\n  return 1;\n}\n')
+    function.specifiers = ('static',)
+    number.value = 2
+    self.assertEqual(module.str, 'static int f()\n{\n  return 2;\n}\n')
+
+  def test_copy_rejects_unknown_attribute(self):
+    with self.assertRaises(TypeError):
+      ast.Id('x').Copy(name='y')
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,260 @@
+"""benchmark.py
+
+End-to-end benchmark harness for the C that c4 generates.
+
+For every .c4 program in the benchmark corpus (benchmarks/ by default), the harness
+
+  1. translates the program with the c4 transpiler,
+  2. compiles the generated C with the local gcc at each requested optimization level, and
+  3. runs the resulting binary.
+
+Transpile time, gcc time, binary size and runtime are recorded to a JSON file, and compared against a stored baseline (benchmarks/baseline.json by default).
+Timings are the minimum over --repeat runs, since the minimum is the least noisy estimate of what the code actually costs.
+Even so, timings of a few milliseconds vary by tens of percent from run to run, so a timing only counts as a regression if it also grew by more than --noise-floor.
+
+Typical usage:
+
+  python -m c4.benchmark                      # run, write results, compare against baseline
+  python -m c4.benchmark --update-baseline    # run and store the results as the new baseline
+  python -m c4.benchmark -O 2 --repeat 5 fib  # only fib.c4, only at -O2
+  python -m c4.benchmark --instrument csv     # measure the overhead of c4 --instrument against the baseline
+
+Benchmark programs are expected to print a result and exit with status 0.
+The output of the first run at every optimization level is compared, so an optimization that changes what a program computes is reported as an error instead of as a speedup.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from . import transformer
+from .__main__ import Translate
+
+BENCHMARK_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIRECTORY, 'baseline.json')
+
+DEFAULT_OUTPUT = os.path.join(BENCHMARK_DIRECTORY, 'results.json')
+
+DEFAULT_LEVELS = ('0', '1', '2', '3')
+
+GCC_FLAGS = ('-Wall', '-Werror', '-Wpedantic', '--std=c89')
+
+# Metrics compared against the baseline. For all of them, larger is worse.
+METRICS = (
+    'transpile_seconds',
+    'gcc_seconds',
+    'binary_bytes',
+    'run_seconds',
+)
+
+# Timings that grew by less than this many seconds are noise, however large the ratio.
+DEFAULT_NOISE_FLOOR = 0.02
+
+
+class BenchmarkError(Exception):
+  pass
+
+
+def FindPrograms(corpus, names=()):
+  programs = sorted(fn[:-len('.c4')] for fn in os.listdir(corpus) if fn.endswith('.c4'))
+  if names:
+    missing = [name for name in names if name not in programs]
+    if missing:
+      raise BenchmarkError('No such benchmark(s) in %s: %s' % (corpus, ', '.join(missing)))
+    programs = [name for name in programs if name in names]
+  return programs
+
+
+def Time(function, repeat):
+  best = None
+  result = None
+  for _ in range(repeat):
+    start = timeit.default_timer()
+    result = function()
+    elapsed = timeit.default_timer() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+
+def GccVersion(gcc):
+  return subprocess.check_output([gcc, '--version']).decode('utf-8', 'replace').splitlines()[0]
+
+
+def Transpile(path, repeat, passes=()):
+  with open(path) as f:
+    string = f.read()
+  return Time(lambda: Translate(string, os.path.basename(path), passes), repeat)
+
+
+def Compile(gcc, c_path, binary_path, level, repeat):
+  command = [gcc, '-O' + level] + list(GCC_FLAGS) + [c_path, '-o', binary_path]
+  def Run():
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+      raise BenchmarkError('%s failed:\n%s' % (' '.join(command), output.decode('utf-8', 'replace')))
+  seconds, _ = Time(Run, repeat)
+  return seconds
+
+
+def Execute(binary_path, repeat, env=None):
+  def Run():
+    process = subprocess.Popen([binary_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+      raise BenchmarkError('%s exited with status %d:\n%s' % (binary_path, process.returncode, stderr.decode('utf-8', 'replace')))
+    return stdout.decode('utf-8', 'replace')
+  return Time(Run, repeat)
+
+
+def RunBenchmark(corpus, name, gcc, levels, repeat, workdir, instrument=None):
+  source_path = os.path.join(corpus, name + '.c4')
+  c_path = os.path.join(workdir, name + '.c')
+  passes = [transformer.Instrumenter(instrument)] if instrument else []
+  # Instrumented binaries write their profile into the workdir rather than the current directory.
+  env = dict(os.environ, C4_PROFILE=os.path.join(workdir, name + '.profile')) if instrument else None
+  transpile_seconds, c_code = Transpile(source_path, repeat, passes)
+  with open(c_path, 'w') as f:
+    f.write(c_code)
+
+  result = {
+      'transpile_seconds': transpile_seconds,
+      'c_bytes': len(c_code),
+      'levels': {},
+  }
+  expected_output = None
+  for level in levels:
+    binary_path = os.path.join(workdir, '%s-O%s' % (name, level))
+    gcc_seconds = Compile(gcc, c_path, binary_path, level, repeat)
+    run_seconds, output = Execute(binary_path, repeat, env)
+    if expected_output is None:
+      expected_output = output
+    elif output != expected_output:
+      raise BenchmarkError('%s prints %r at -O%s but %r at -O%s' % (name, output, level, expected_output, levels[0]))
+    result['levels']['O' + level] = {
+        'gcc_seconds': gcc_seconds,
+        'binary_bytes': os.path.getsize(binary_path),
+        'run_seconds': run_seconds,
+    }
+  result['output'] = expected_output
+  return result
+
+
+def RunBenchmarks(corpus, names, gcc, levels, repeat, instrument=None):
+  workdir = tempfile.mkdtemp(prefix='c4-benchmark-')
+  try:
+    results = {
+        'gcc': GccVersion(gcc),
+        'gcc_flags': list(GCC_FLAGS),
+        'repeat': repeat,
+        'programs': dict((name, RunBenchmark(corpus, name, gcc, levels, repeat, workdir, instrument)) for name in names),
+    }
+    if instrument:
+      results['instrument'] = instrument
+    return results
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def Measurements(results):
+  """Flattens results into {(program, level, metric): value}.
+
+  transpile_seconds does not depend on the optimization level, so its level is None.
+  """
+  flat = {}
+  for name, program in results['programs'].items():
+    flat[(name, None, 'transpile_seconds')] = program['transpile_seconds']
+    for level, measurements in program['levels'].items():
+      for metric in METRICS:
+        if metric in measurements:
+          flat[(name, level, metric)] = measurements[metric]
+  return flat
+
+
+def Compare(results, baseline, threshold, noise_floor=0.0, thresholds=None):
+  """Returns a list of (program, level, metric, baseline value, new value, ratio, regressed).
+
+  Only measurements present in both results and baseline are compared.
+  A measurement has regressed if it grew by more than its threshold (e.g. 0.1 for 10%), which is thresholds[metric] if given and threshold otherwise.
+  Timings must also have grown by more than noise_floor seconds.
+  """
+  thresholds = thresholds or {}
+  new = Measurements(results)
+  old = Measurements(baseline)
+  rows = []
+  for key in sorted(set(new) & set(old), key=lambda key: (key[0], key[1] or '', METRICS.index(key[2]))):
+    name, level, metric = key
+    ratio = new[key] / old[key] if old[key] else float('inf') if new[key] else 1.0
+    regressed = ratio > 1.0 + thresholds.get(metric, threshold)
+    if metric.endswith('_seconds'):
+      regressed = regressed and new[key] - old[key] > noise_floor
+    rows.append((name, level, metric, old[key], new[key], ratio, regressed))
+  return rows
+
+
+def MetricThreshold(string):
+  # METRIC=THRESHOLD, for --metric-threshold.
+  metric, _, threshold = string.partition('=')
+  if metric not in METRICS:
+    raise argparse.ArgumentTypeError('unknown metric %r (one of %s)' % (metric, ', '.join(METRICS)))
+  try:
+    return metric, float(threshold)
+  except ValueError:
+    raise argparse.ArgumentTypeError('%r is not a number' % threshold)
+
+
+def FormatComparison(rows):
+  lines = ['%-12s %-5s %-18s %14s %14s %8s' % ('program', 'level', 'metric', 'baseline', 'new', 'ratio')]
+  for name, level, metric, old, new, ratio, regressed in rows:
+    lines.append('%-12s %-5s %-18s %14.6g %14.6g %8.3f%s' % (name, level or '-', metric, old, new, ratio, '  REGRESSION' if regressed else ''))
+  return '\n'.join(lines) + '\n'
+
+
+def main():
+  argparser = argparse.ArgumentParser(prog='python -m c4.benchmark', description='Benchmark the C generated by c4: transpile time, gcc time, binary size and runtime.')
+  argparser.add_argument('programs', nargs='*', help='names of the benchmarks to run (default: all of them)')
+  argparser.add_argument('--corpus', default=BENCHMARK_DIRECTORY, help='directory containing the .c4 benchmark programs')
+  argparser.add_argument('--baseline', default=DEFAULT_BASELINE, help='JSON file with the results to compare against')
+  argparser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON file to write the results to')
+  argparser.add_argument('--update-baseline', action='store_true', help='write the results to the baseline file instead of comparing against it')
+  argparser.add_argument('-O', dest='levels', action='append', help='gcc optimization level, may be repeated (default: 0 1 2 3)')
+  argparser.add_argument('--repeat', type=int, default=5, help='number of times each step is timed; the minimum is kept (default: %(default)s)')
+  argparser.add_argument('--threshold', type=float, default=0.1, help='relative growth that counts as a regression (default: %(default)s)')
+  argparser.add_argument('--metric-threshold', metavar='METRIC=THRESHOLD', type=MetricThreshold, action='append', default=[], help='relative growth that counts as a regression for one metric, e.g. gcc_seconds=0.25; may be repeated')
+  argparser.add_argument('--noise-floor', metavar='MS', type=float, default=DEFAULT_NOISE_FLOOR * 1000, help='timings that grew by less than this many milliseconds never count as regressions (default: %(default)s)')
+  argparser.add_argument('--gcc', default=os.environ.get('CC', 'gcc'), help='C compiler to use (default: $CC or gcc)')
+  argparser.add_argument('--instrument', choices=sorted(transformer.INSTRUMENTATION_DUMPS), help='benchmark the programs translated with c4 --instrument, to measure its overhead')
+  args = argparser.parse_args()
+
+  try:
+    names = FindPrograms(args.corpus, args.programs)
+    results = RunBenchmarks(args.corpus, names, args.gcc, tuple(args.levels or DEFAULT_LEVELS), args.repeat, args.instrument)
+  except (BenchmarkError, OSError) as e:
+    sys.stderr.write('%s\n' % e)
+    exit(1)
+
+  output = args.baseline if args.update_baseline else args.output
+  with open(output, 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.write('\n')
+  sys.stdout.write('Wrote %s\n' % output)
+
+  if not args.update_baseline:
+    if not os.path.exists(args.baseline):
+      sys.stdout.write('No baseline at %s; run with --update-baseline to create one.\n' % args.baseline)
+      return
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    rows = Compare(results, baseline, args.threshold, args.noise_floor / 1000.0, dict(args.metric_threshold))
+    sys.stdout.write(FormatComparison(rows))
+    if any(row[-1] for row in rows):
+      exit(2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,56 @@
+import unittest
+
+from . import benchmark
+
+
+def Results(transpile_seconds, run_seconds):
+  return {
+      'programs': {
+          'fib': {
+              'transpile_seconds': transpile_seconds,
+              'levels': {
+                  'O2': {
+                      'gcc_seconds': 1.0,
+                      'binary_bytes': 100,
+                      'run_seconds': run_seconds,
+                  },
+              },
+          },
+      },
+  }
+
+
+class CompareTest(unittest.TestCase):
+
+  def test_regression_over_threshold(self):
+    rows = benchmark.Compare(Results(1.0, 1.5), Results(1.0, 1.0), 0.1)
+    self.assertEqual(
+        [(row[1], row[2], row[-1]) for row in rows],
+        [
+            (None, 'transpile_seconds', False),
+            ('O2', 'gcc_seconds', False),
+            ('O2', 'binary_bytes', False),
+            ('O2', 'run_seconds', True),
+        ])
+
+  def test_noise_floor(self):
+    rows = benchmark.Compare(Results(0.0013, 0.05), Results(0.001, 0.04), 0.1, noise_floor=0.02)
+    self.assertEqual([row[-1] for row in rows], [False, False, False, False])
+    rows = benchmark.Compare(Results(0.0013, 0.09), Results(0.001, 0.04), 0.1, noise_floor=0.02)
+    self.assertEqual([(row[2], row[-1]) for row in rows if row[-1]], [('run_seconds', True)])
+
+  def test_metric_thresholds(self):
+    rows = benchmark.Compare(Results(1.0, 1.5), Results(1.0, 1.0), 0.1, thresholds={'run_seconds': 0.6})
+    self.assertFalse(any(row[-1] for row in rows))
+    rows = benchmark.Compare(Results(1.2, 1.0), Results(1.0, 1.0), 0.5, thresholds={'transpile_seconds': 0.1})
+    self.assertEqual([(row[2], row[-1]) for row in rows if row[-1]], [('transpile_seconds', True)])
+
+  def test_only_common_measurements_are_compared(self):
+    baseline = Results(1.0, 1.0)
+    del baseline['programs']['fib']['levels']['O2']
+    rows = benchmark.Compare(Results(2.0, 2.0), baseline, 0.1)
+    self.assertEqual(rows, [('fib', None, 'transpile_seconds', 1.0, 2.0, 2.0, True)])
+
+
+if __name__ == '__main__':
+  unittest.main()
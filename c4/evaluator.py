@@ -0,0 +1,513 @@
+"""evaluator.py
+
+A small interpreter for pure c4 functions, for evaluating initializers at translation time (see CompileTimeEvaluator in transformer.py).
+
+It supports what is needed to compute tables of numbers:
+
+  - values are integers and floating point numbers (char literals are integers, as in C),
+  - statements are blocks, variable declarations (of numbers and of arrays of numbers), expression statements, if, while and return,
+  - expressions are literals, local variables, array elements, function calls, and the C operators on numbers, and
+  - functions may call each other, and the pure functions of math.h (sin, cos, sqrt, ...).
+
+Values follow C, with the sizes of x86-64 Linux: every value has a C type, operands go through the integer promotions and the usual arithmetic conversions, results wrap around to their type (so unsigned arithmetic is exact, and signed overflow wraps as it does on the hardware), integer division truncates toward zero, and float arithmetic rounds to single precision.
+A value that is stored in a variable, passed as an argument or returned is converted to the declared type.
+
+Evaluation is bounded, so translation cannot hang or run out of memory: Interpreter raises EvaluationError after max_steps statements and expressions, when the variables alive at once (including the table being computed) hold more than max_memory numbers, or when calls nest deeper than max_depth.
+"""
+import math
+import struct
+
+from . import ast
+
+DEFAULT_MAX_STEPS = 5000000
+
+DEFAULT_MAX_MEMORY = 1 << 20
+
+DEFAULT_MAX_DEPTH = 100
+
+# (bits, signed) of the integer types, on x86-64 Linux.
+INTEGER_TYPES = {
+    'char': (8, True), 'short': (16, True), 'int': (32, True), 'long': (64, True),
+    'int8_t': (8, True), 'int16_t': (16, True), 'int32_t': (32, True), 'int64_t': (64, True),
+    'uint8_t': (8, False), 'uint16_t': (16, False), 'uint32_t': (32, False), 'uint64_t': (64, False),
+    'size_t': (64, False), 'ssize_t': (64, True), 'ptrdiff_t': (64, True), 'intptr_t': (64, True), 'uintptr_t': (64, False),
+}
+
+# Sizes of the floating point types, in bytes.
+FLOAT_TYPES = {'float': 4, 'double': 8}
+
+# The types of values are (bits, signed) for integers, as above, and the type name for floating point numbers.
+INT = INTEGER_TYPES['int']
+LONG = INTEGER_TYPES['long']
+SIZE_T = INTEGER_TYPES['size_t']
+
+INT_MAX = (1 << 31) - 1
+LONG_MAX = (1 << 63) - 1
+
+
+def MathFunction(function):
+  # The math.h functions return double, even where Python's return int (e.g. floor).
+  return lambda *args: float(function(*args))
+
+MATH_FUNCTIONS = dict((name, MathFunction(getattr(math, name))) for name in (
+    'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'atan2', 'sinh', 'cosh', 'tanh',
+    'exp', 'log', 'log10', 'pow', 'sqrt', 'fabs', 'floor', 'ceil', 'fmod'))
+MATH_FUNCTIONS['abs'] = MATH_FUNCTIONS['labs'] = abs
+
+# The math.h functions return double, except for these.
+MATH_TYPES = {'abs': INT, 'labs': LONG}
+
+ASSIGNMENT_OPERATORS = ('=', '+=', '-=', '*=', '/=', '%=', '<<=', '>>=', '&=', '^=', '|=')
+
+COMPARISON_OPERATORS = ('<', '<=', '>', '>=', '==', '!=')
+
+
+class EvaluationError(ValueError):
+  pass
+
+
+class ReturnValue(Exception):
+
+  def __init__(self, value):
+    super(ReturnValue, self).__init__()
+    self.value = value
+
+
+def StripQualifiers(type_):
+  while isinstance(type_, (ast.ConstType, ast.VolatileType)):
+    type_ = type_.type
+  return type_
+
+
+def Dimensions(type_):
+  """Returns (dimensions, element type) of type_, e.g. ([4, 8], double) for [4][8]double, and ([], int) for int."""
+  dimensions = []
+  type_ = StripQualifiers(type_)
+  while isinstance(type_, ast.ArrayType):
+    dimensions.append(type_.count)
+    type_ = StripQualifiers(type_.type)
+  return dimensions, type_
+
+
+def Cells(dimensions):
+  cells = 1
+  for dimension in dimensions:
+    cells *= dimension
+  return cells
+
+
+def IsNumber(type_):
+  type_ = StripQualifiers(type_)
+  return isinstance(type_, ast.TypeId) and (type_.value in INTEGER_TYPES or type_.value in FLOAT_TYPES)
+
+
+def ValueType(type_):
+  """Returns the type of the values of the number type type_, e.g. (32, False) for uint32_t."""
+  type_ = StripQualifiers(type_)
+  if not IsNumber(type_):
+    raise EvaluationError('%s values can not be computed at compile time' % type_.EmptyDeclare())
+  return INTEGER_TYPES.get(type_.value, type_.value)
+
+
+def Wrap(value, value_type):
+  """Converts value to the type value_type, like C does."""
+  if value_type not in FLOAT_TYPES:
+    if isinstance(value, float):
+      if math.isinf(value) or math.isnan(value):
+        raise EvaluationError('%r can not be converted to an integer' % value)
+      value = int(value)
+    bits, signed = value_type
+    value &= (1 << bits) - 1
+    if signed and value >> (bits - 1):
+      value -= 1 << bits
+    return value
+  value = float(value)
+  if value_type == 'float' and not (math.isinf(value) or math.isnan(value)):
+    try:
+      value = struct.unpack('f', struct.pack('f', value))[0]
+    except OverflowError:
+      raise EvaluationError('%r is too large for a float' % value)
+  return value
+
+
+def TakesNumbers(function):
+  """Returns whether the FunctionDefinition function takes and returns numbers, which is needed to call it at compile time."""
+  type_ = function.type
+  return isinstance(type_, ast.FunctionType) and IsNumber(type_.return_type) and all(IsNumber(t) for t in type_.argument_types)
+
+
+def Convert(value, type_):
+  """Converts value to type_, like storing it in a variable of that type does in C."""
+  return Wrap(value, ValueType(type_))
+
+
+def LiteralType(value):
+  # A decimal integer constant is an int, a long or an unsigned long, whichever is the first to hold it.
+  if value <= INT_MAX:
+    return INT
+  return LONG if value <= LONG_MAX else (64, False)
+
+
+def Promote(value_type):
+  # The integer promotions: types narrower than int become int.
+  if value_type not in FLOAT_TYPES and value_type[0] < INT[0]:
+    return INT
+  return value_type
+
+
+def CommonType(a, b):
+  """Returns the type that the usual arithmetic conversions convert operands of types a and b to."""
+  a, b = Promote(a), Promote(b)
+  for float_type in ('double', 'float'):
+    if float_type in (a, b):
+      return float_type
+  if a[1] == b[1]:
+    return max(a, b)
+  unsigned, signed = (b, a) if a[1] else (a, b)
+  # The signed type wins only if it holds all the values of the unsigned one.
+  return signed if signed[0] > unsigned[0] else unsigned
+
+
+def Literal(value):
+  """Returns the c4 expression for the number value."""
+  if isinstance(value, float):
+    if math.isinf(value) or math.isnan(value):
+      raise EvaluationError('%r has no literal in C89' % value)
+    return ast.Float(value)
+  if value == -LONG_MAX - 1:
+    # Negating 9223372036854775808 would not fit in a long.
+    return ast.ParentheticalExpression(ast.BinaryOperation(ast.Int(-LONG_MAX), '-', ast.Int(1)))
+  if value > LONG_MAX:
+    return ast.Int('%dUL' % value)
+  return ast.Int(value)
+
+
+def CDivide(a, b):
+  # C truncates toward zero, Python rounds down.
+  quotient = abs(a) // abs(b)
+  return quotient if (a < 0) == (b < 0) else -quotient
+
+
+class Frame(object):
+  """The local variables of a call: values maps names to numbers, or to (nested) lists for arrays, and types maps names to their declared types."""
+
+  def __init__(self):
+    self.values = {}
+    self.types = {}
+    self.cells = {}
+
+
+class Interpreter(object):
+  """Evaluates calls and expressions, given the functions that may be called, {name: ast.FunctionDefinition}.
+
+  The limits apply to everything one Interpreter evaluates, so use a new one for every independent evaluation.
+  """
+
+  def __init__(self, functions, max_steps=DEFAULT_MAX_STEPS, max_memory=DEFAULT_MAX_MEMORY, max_depth=DEFAULT_MAX_DEPTH):
+    self.functions = functions
+    self.max_steps = max_steps
+    self.max_memory = max_memory
+    self.max_depth = max_depth
+    self.steps = 0
+    self.memory = 0
+    self.depth = 0
+
+  def Step(self):
+    self.steps += 1
+    if self.steps > self.max_steps:
+      raise EvaluationError('evaluation takes more than %d steps' % self.max_steps)
+
+  def Allocate(self, cells):
+    self.memory += cells
+    if self.memory > self.max_memory:
+      raise EvaluationError('evaluation needs more than %d values of memory' % self.max_memory)
+
+  def ReturnType(self, name):
+    if name in MATH_FUNCTIONS and name not in self.functions:
+      return MATH_TYPES.get(name, 'double')
+    if name not in self.functions:
+      raise EvaluationError('%s is neither a function of numbers defined before it is used, nor a math.h function' % name)
+    return ValueType(self.functions[name].type.return_type)
+
+  def Call(self, name, args):
+    return_type = self.ReturnType(name)
+    if name not in self.functions:
+      if return_type in FLOAT_TYPES:
+        args = [float(arg) for arg in args]
+      else:
+        args = [Wrap(arg, return_type) for arg in args]
+      try:
+        return Wrap(MATH_FUNCTIONS[name](*args), return_type)
+      except (ValueError, OverflowError, TypeError) as e:
+        raise EvaluationError('%s%r: %s' % (name, tuple(args), e))
+    function = self.functions[name]
+    type_ = function.type
+    if len(args) != len(type_.argument_names):
+      raise EvaluationError('%s takes %d argument(s), but is called with %d' % (name, len(type_.argument_names), len(args)))
+    if self.depth >= self.max_depth:
+      raise EvaluationError('calls nest more than %d deep' % self.max_depth)
+    frame = Frame()
+    for argument_name, argument_type, value in zip(type_.argument_names, type_.argument_types, args):
+      frame.types[argument_name.value] = argument_type
+      frame.values[argument_name.value] = Convert(value, argument_type)
+      frame.cells[argument_name.value] = 1
+    self.Allocate(len(args))
+    self.depth += 1
+    try:
+      self.Execute(function.body, frame)
+    except ReturnValue as e:
+      return Wrap(e.value, return_type)
+    except RuntimeError:
+      # Python's own recursion limit, e.g. for very deeply nested expressions.
+      raise EvaluationError('%s is too deeply nested to evaluate' % name)
+    finally:
+      self.depth -= 1
+      self.memory -= sum(frame.cells.values())
+    raise EvaluationError('%s ends without returning a value' % name)
+
+  def Execute(self, stmt, frame):
+    self.Step()
+    if isinstance(stmt, ast.Block):
+      for child in stmt.statements:
+        self.Execute(child, frame)
+    elif isinstance(stmt, ast.VariableDeclaration):
+      self.Declare(stmt, frame)
+    elif isinstance(stmt, ast.ExpressionStatement):
+      self.Evaluate(stmt.expression, frame)
+    elif isinstance(stmt, ast.If):
+      if self.Evaluate(stmt.condition, frame):
+        self.Execute(stmt.body, frame)
+      elif stmt.orelse is not None:
+        self.Execute(stmt.orelse, frame)
+    elif isinstance(stmt, ast.While):
+      while self.Evaluate(stmt.condition, frame):
+        self.Execute(stmt.body, frame)
+    elif isinstance(stmt, ast.Return):
+      raise ReturnValue(self.Evaluate(stmt.expression, frame))
+    else:
+      raise EvaluationError('%s statements can not be evaluated at compile time' % type(stmt).__name__)
+
+  def Declare(self, stmt, frame):
+    name = stmt.name.value
+    dimensions, element = Dimensions(stmt.type)
+    if not IsNumber(element):
+      raise EvaluationError('%s has type %s, which can not be computed at compile time' % (name, stmt.type.EmptyDeclare()))
+    # A declaration inside a loop declares the same variable again on every iteration.
+    self.memory -= frame.cells.pop(name, 0)
+    self.Allocate(Cells(dimensions))
+    frame.cells[name] = Cells(dimensions)
+    frame.types[name] = stmt.type
+    if dimensions:
+      if stmt.value is not None:
+        raise EvaluationError('array %s can not have an initializer at compile time' % name)
+      frame.values[name] = self.Zeros(dimensions, element)
+    else:
+      frame.values[name] = Convert(self.Evaluate(stmt.value, frame) if stmt.value is not None else 0, stmt.type)
+
+  def Zeros(self, dimensions, element):
+    if len(dimensions) == 1:
+      return [Convert(0, element)] * dimensions[0]
+    return [self.Zeros(dimensions[1:], element) for _ in range(dimensions[0])]
+
+  def Reference(self, expr, frame):
+    """Returns (container, key, type) for the variable or array element expr, so that container[key] is its value."""
+    if isinstance(expr, ast.Id):
+      if expr.value not in frame.values:
+        raise EvaluationError('%s is not a local variable (global variables can not be used at compile time)' % expr.value)
+      return frame.values, expr.value, frame.types[expr.value]
+    elif isinstance(expr, ast.Subscript):
+      container, key, type_ = self.Reference(expr.subscriptable, frame)
+      array = container[key]
+      type_ = StripQualifiers(type_)
+      if not isinstance(array, list):
+        raise EvaluationError('%s is not an array' % expr.subscriptable.str)
+      index = self.Evaluate(expr.index, frame)
+      if isinstance(index, float) or not 0 <= index < len(array):
+        raise EvaluationError('index %r is out of bounds for %s' % (index, expr.subscriptable.str))
+      return array, index, type_.type
+    elif isinstance(expr, ast.ParentheticalExpression):
+      return self.Reference(expr.expression, frame)
+    else:
+      raise EvaluationError('%s is not a variable or array element' % expr.str)
+
+  def Load(self, expr, frame):
+    """Returns (value, type) of the variable or array element expr."""
+    container, key, type_ = self.Reference(expr, frame)
+    value = container[key]
+    if isinstance(value, list):
+      raise EvaluationError('array %s can only be used element by element' % expr.str)
+    return value, ValueType(type_)
+
+  def Store(self, expr, frame, value):
+    container, key, type_ = self.Reference(expr, frame)
+    if isinstance(container[key], list):
+      raise EvaluationError('array %s can only be assigned element by element' % expr.str)
+    container[key] = Convert(value, type_)
+    return container[key], ValueType(type_)
+
+  def VariableType(self, expr, frame):
+    # The type of the variable or array element expr, without evaluating its indices.
+    while isinstance(expr, (ast.Subscript, ast.ParentheticalExpression)):
+      expr = expr.subscriptable if isinstance(expr, ast.Subscript) else expr.expression
+    if not isinstance(expr, ast.Id):
+      raise EvaluationError('%s is not a variable or array element' % expr.str)
+    _, _, type_ = self.Reference(expr, frame)
+    return ValueType(Dimensions(type_)[1])
+
+  def TypeOf(self, expr, frame):
+    """Returns the type of the value of expr, without evaluating it."""
+    if isinstance(expr, ast.Int):
+      return LiteralType(expr.value)
+    elif isinstance(expr, ast.Float):
+      return 'double'
+    elif isinstance(expr, ast.Char):
+      return INT
+    elif isinstance(expr, ast.ParentheticalExpression):
+      return self.TypeOf(expr.expression, frame)
+    elif isinstance(expr, (ast.Id, ast.Subscript)):
+      return self.VariableType(expr, frame)
+    elif isinstance(expr, ast.PostfixOperation):
+      return self.VariableType(expr.expression, frame)
+    elif isinstance(expr, ast.FunctionCall) and isinstance(expr.function, ast.Id):
+      return self.ReturnType(expr.function.value)
+    elif isinstance(expr, ast.PrefixOperation):
+      if expr.operator in ('++', '--'):
+        return self.VariableType(expr.expression, frame)
+      return INT if expr.operator == '!' else Promote(self.TypeOf(expr.expression, frame))
+    elif isinstance(expr, ast.BinaryOperation):
+      if expr.operator in ('&&', '||') + COMPARISON_OPERATORS:
+        return INT
+      elif expr.operator in ASSIGNMENT_OPERATORS:
+        return self.VariableType(expr.left, frame)
+      elif expr.operator in ('<<', '>>'):
+        return Promote(self.TypeOf(expr.left, frame))
+      return CommonType(self.TypeOf(expr.left, frame), self.TypeOf(expr.right, frame))
+    elif isinstance(expr, ast.ConditionalExpression):
+      return CommonType(self.TypeOf(expr.condition, frame), self.TypeOf(expr.right, frame))
+    elif isinstance(expr, ast.SizeofType):
+      return SIZE_T
+    raise EvaluationError('%s can not be evaluated at compile time' % expr.str)
+
+  def Evaluate(self, expr, frame):
+    """Returns the value of expr."""
+    return self.Typed(expr, frame)[0]
+
+  def Typed(self, expr, frame):
+    """Returns (value, type) of expr."""
+    self.Step()
+    if isinstance(expr, ast.Int):
+      return expr.value, LiteralType(expr.value)
+    elif isinstance(expr, ast.Float):
+      return expr.value, 'double'
+    elif isinstance(expr, ast.Char):
+      return ord(expr.value), INT
+    elif isinstance(expr, ast.ParentheticalExpression):
+      return self.Typed(expr.expression, frame)
+    elif isinstance(expr, (ast.Id, ast.Subscript)):
+      return self.Load(expr, frame)
+    elif isinstance(expr, ast.FunctionCall):
+      if not isinstance(expr.function, ast.Id):
+        raise EvaluationError('only functions called by name can be evaluated at compile time, not %s' % expr.function.str)
+      value = self.Call(expr.function.value, [self.Evaluate(arg, frame) for arg in expr.arguments])
+      return value, self.ReturnType(expr.function.value)
+    elif isinstance(expr, ast.PrefixOperation):
+      if expr.operator in ('++', '--'):
+        return self.Store(expr.expression, frame, self.Arithmetic(expr.operator[0], self.Load(expr.expression, frame), (1, INT))[0])
+      value, value_type = self.Typed(expr.expression, frame)
+      if expr.operator == '!':
+        return int(not value), INT
+      value_type = Promote(value_type)
+      if expr.operator == '-':
+        return Wrap(-value, value_type), value_type
+      elif expr.operator == '+':
+        return value, value_type
+      elif expr.operator == '~' and value_type not in FLOAT_TYPES:
+        return Wrap(~value, value_type), value_type
+      raise EvaluationError('%s%r can not be evaluated at compile time' % (expr.operator, value))
+    elif isinstance(expr, ast.PostfixOperation):
+      value = self.Load(expr.expression, frame)
+      self.Store(expr.expression, frame, self.Arithmetic(expr.operator[0], value, (1, INT))[0])
+      return value
+    elif isinstance(expr, ast.BinaryOperation):
+      if expr.operator == '&&':
+        return int(bool(self.Evaluate(expr.left, frame)) and bool(self.Evaluate(expr.right, frame))), INT
+      elif expr.operator == '||':
+        return int(bool(self.Evaluate(expr.left, frame)) or bool(self.Evaluate(expr.right, frame))), INT
+      elif expr.operator == '=':
+        return self.Store(expr.left, frame, self.Evaluate(expr.right, frame))
+      elif expr.operator in ASSIGNMENT_OPERATORS:
+        right = self.Typed(expr.right, frame)
+        return self.Store(expr.left, frame, self.Arithmetic(expr.operator[:-1], self.Load(expr.left, frame), right)[0])
+      # Long operator chains (a + b + c + ...) are left-deep, so they are evaluated with a loop down the left operands rather than by recursion.
+      operations = [expr]
+      while isinstance(operations[-1].left, ast.BinaryOperation) and operations[-1].left.operator not in ('&&', '||') + ASSIGNMENT_OPERATORS:
+        self.Step()
+        operations.append(operations[-1].left)
+      value = self.Typed(operations[-1].left, frame)
+      for operation in reversed(operations):
+        value = self.Arithmetic(operation.operator, value, self.Typed(operation.right, frame))
+      return value
+    elif isinstance(expr, ast.ConditionalExpression):
+      # The parser stores a ? b : c as ConditionalExpression(a, b, c).
+      # As in C, the result has the common type of b and c, whichever is evaluated.
+      value_type = CommonType(self.TypeOf(expr.condition, frame), self.TypeOf(expr.right, frame))
+      value, _ = self.Typed(expr.condition if self.Evaluate(expr.left, frame) else expr.right, frame)
+      return Wrap(value, value_type), value_type
+    elif isinstance(expr, ast.SizeofType):
+      type_ = StripQualifiers(expr.type)
+      if isinstance(type_, ast.TypeId) and type_.value in INTEGER_TYPES:
+        return INTEGER_TYPES[type_.value][0] // 8, SIZE_T
+      elif isinstance(type_, ast.TypeId) and type_.value in FLOAT_TYPES:
+        return FLOAT_TYPES[type_.value], SIZE_T
+      raise EvaluationError('sizeof(%s) can not be evaluated at compile time' % expr.type.EmptyDeclare())
+    else:
+      raise EvaluationError('%s can not be evaluated at compile time' % expr.str)
+
+  def Arithmetic(self, operator, left, right):
+    """Returns (value, type) of left operator right, where left and right are (value, type) pairs."""
+    (a, a_type), (b, b_type) = left, right
+    if operator in ('<<', '>>'):
+      # The result has the type of the left operand, which is not converted to a common type.
+      value_type = Promote(a_type)
+      if value_type in FLOAT_TYPES or b_type in FLOAT_TYPES:
+        raise EvaluationError('%r %s %r can not be evaluated at compile time' % (a, operator, b))
+      if not 0 <= b < value_type[0]:
+        raise EvaluationError('shift by %d' % b)
+      return Wrap(a << b if operator == '<<' else a >> b, value_type), value_type
+    value_type = CommonType(a_type, b_type)
+    a, b = Wrap(a, value_type), Wrap(b, value_type)
+    integers = value_type not in FLOAT_TYPES
+    if operator == '<':
+      return int(a < b), INT
+    elif operator == '<=':
+      return int(a <= b), INT
+    elif operator == '>':
+      return int(a > b), INT
+    elif operator == '>=':
+      return int(a >= b), INT
+    elif operator == '==':
+      return int(a == b), INT
+    elif operator == '!=':
+      return int(a != b), INT
+    elif operator == '+':
+      value = a + b
+    elif operator == '-':
+      value = a - b
+    elif operator == '*':
+      value = a * b
+    elif operator in ('/', '%') and (integers or operator == '/'):
+      if b == 0:
+        raise EvaluationError('division by zero')
+      if operator == '/':
+        value = CDivide(a, b) if integers else a / b
+      else:
+        value = a - b * CDivide(a, b)
+    elif integers and operator == '&':
+      value = a & b
+    elif integers and operator == '|':
+      value = a | b
+    elif integers and operator == '^':
+      value = a ^ b
+    else:
+      raise EvaluationError('%r %s %r can not be evaluated at compile time' % (a, operator, b))
+    return Wrap(value, value_type), value_type
@@ -0,0 +1,119 @@
+import unittest
+
+from . import evaluator
+from . import parser
+
+
+def Functions(string):
+  return dict((stmt.name.value, stmt) for stmt in parser.Parse(string, '<unittest>').statements)
+
+
+class InterpreterTest(unittest.TestCase):
+
+  def Call(self, string, name, *args, **limits):
+    return evaluator.Interpreter(Functions(string), **limits).Call(name, list(args))
+
+  def test_loops_and_locals(self):
+    self.assertEqual(self.Call("""
+        ;f triangle(n int) int {
+          ;v sum int = 0;
+          ;v i int = 1;
+          while i <= n {
+            sum += i++;
+          }
+          return sum;
+        }
+    """, 'triangle', 100), 5050)
+
+  def test_arrays_and_calls(self):
+    self.assertEqual(self.Call("""
+        ;f square(x int) int { return x * x; }
+        ;f sum_of_squares(n int) long {
+          ;v squares [10]long;
+          ;v i int = 0;
+          ;v sum long = 0;
+          while i < n {
+            squares[i] = square(i);
+            i++;
+          }
+          while i {
+            sum = sum + squares[--i];
+          }
+          return sum;
+        }
+    """, 'sum_of_squares', 10), 285)
+
+  def test_c_division(self):
+    string = ';f div(a int, b int) int { return a / b; } ;f mod(a int, b int) int { return a % b; }'
+    self.assertEqual(self.Call(string, 'div', -7, 2), -3)
+    self.assertEqual(self.Call(string, 'mod', -7, 2), -1)
+    with self.assertRaises(evaluator.EvaluationError):
+      self.Call(string, 'div', 1, 0)
+
+  def test_conversions(self):
+    self.assertEqual(self.Call(';f f(x int) char { return x; }', 'f', 200), -56)
+    self.assertEqual(self.Call(';f f(x int) size_t { return x; }', 'f', -1), (1 << 64) - 1)
+    self.assertEqual(self.Call(';f f(x double) int { return x; }', 'f', -2.9), -2)
+    self.assertEqual(self.Call(';f f(x double) float { return x; }', 'f', 0.1), 0.10000000149011612)
+    self.assertEqual(self.Call(';f f(x int) double { return x / 2; }', 'f', 3), 1.0)
+    self.assertEqual(self.Call(';f f(x int) double { return x / 2.0; }', 'f', 3), 1.5)
+
+  def test_unsigned_arithmetic(self):
+    self.assertEqual(self.Call(';f f(h uint32_t) long { return ~h >> 28; }', 'f', 0), 15)
+    self.assertEqual(self.Call(';f f(a uint32_t, b uint32_t) long { return (a * b) >> 28; }', 'f', 123456789, 987654321), 15)
+    self.assertEqual(self.Call(';f f(h uint32_t) long { return h - 1; }', 'f', 0), (1 << 32) - 1)
+    self.assertEqual(self.Call(';f f(h uint32_t) int { return -1 < h; }', 'f', 0), 0)
+    self.assertEqual(self.Call(';f f(h uint32_t) long { return -h / 2; }', 'f', 2), (1 << 31) - 1)
+    self.assertEqual(self.Call(';f f(h uint32_t, x long) long { return x * h; }', 'f', (1 << 32) - 1, -1), 1 - (1 << 32))
+    self.assertEqual(self.Call(';f f(h size_t) double { return h; }', 'f', -1), 2.0 ** 64)
+
+  def test_integer_promotions(self):
+    self.assertEqual(self.Call(';f f(a uint8_t) long { return ~a; }', 'f', 200), -201)
+    self.assertEqual(self.Call(';f f(a uint16_t) long { return a << 16; }', 'f', 1), 1 << 16)
+    self.assertEqual(self.Call(';f f(a int) long { return a << 31; }', 'f', 1), -(1 << 31))
+    self.assertEqual(self.Call(';f f(c int, u uint32_t) long { return c ? -1 : u; }', 'f', 1, 0), (1 << 32) - 1)
+    self.assertEqual(self.Call(';f f(x int) long { return x + 2147483647; }', 'f', 1), -(1 << 31))
+    self.assertEqual(self.Call(';f f(x int) long { return x + 2147483648; }', 'f', 1), (1 << 31) + 1)
+    self.assertEqual(self.Call(';f f(x float) double { return x * 3; }', 'f', 0.1), 0.30000001192092896)
+
+  def test_math_functions(self):
+    self.assertEqual(self.Call(';f f(x double) double { return floor(sqrt(x)); }', 'f', 10), 3.0)
+    with self.assertRaises(evaluator.EvaluationError):
+      self.Call(';f f(x double) double { return sqrt(x); }', 'f', -1)
+
+  def test_step_limit(self):
+    with self.assertRaises(evaluator.EvaluationError):
+      self.Call(';f f(x int) int { while 1 { x++; } return x; }', 'f', 0, max_steps=1000)
+
+  def test_memory_limit(self):
+    string = ';f f(n int) int { ;v a [1000]int; while n-- { ;v b [1000]int; } return 0; }'
+    self.assertEqual(self.Call(string, 'f', 100, max_memory=2001), 0)
+    with self.assertRaises(evaluator.EvaluationError):
+      self.Call(string, 'f', 1, max_memory=1999)
+
+  def test_depth_limit(self):
+    with self.assertRaises(evaluator.EvaluationError):
+      self.Call(';f f(x int) int { return f(x); }', 'f', 0)
+
+  def test_unsupported(self):
+    with self.assertRaises(evaluator.EvaluationError):
+      self.Call(';v g int; ;f f(x int) int { return g; }', 'f', 0)
+    with self.assertRaises(evaluator.EvaluationError):
+      self.Call(';f f(x int) int { return puts("hi"); }', 'f', 0)
+    with self.assertRaises(evaluator.EvaluationError):
+      self.Call(';f f(x int) *char { return 0; }', 'f', 0)
+
+
+class LiteralTest(unittest.TestCase):
+
+  def test_literals(self):
+    self.assertEqual(evaluator.Literal(-5).str, '-5')
+    self.assertEqual(evaluator.Literal(0.5).str, '0.5')
+    self.assertEqual(evaluator.Literal(-(1 << 63)).str, '(-9223372036854775807 - 1)')
+    self.assertEqual(evaluator.Literal((1 << 64) - 1).str, '18446744073709551615UL')
+    with self.assertRaises(evaluator.EvaluationError):
+      evaluator.Literal(float('inf'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,28 +1,43 @@
 """parser.py
 
-This module has two components:
+This module has three components:
 
-  1. the Parse function, and
-  2. the Parser class.
+  1. the Parse function,
+  2. the TokenBuffer class, and
+  3. the Parser class.
 
 Parse is a convenience function around Parser.
 For most intents and purposes, I don't think you will need to use the Parser class directly.
 
+TokenBuffer does the lexical analysis.
+It tokenizes the whole file in one pass and stores the tokens column-wise, in three parallel arrays:
+
+  -- kinds, the index of each token's type in TOKEN_TYPES,
+  -- starts, the offset of the first character of each token, and
+  -- ends, the offset one past the last character of each token.
+
+So a token is just an index into these arrays, and costs three machine integers instead of a namedtuple and a substring.
+Token values (e.g. the int of an 'int' token) are only materialized when the parser asks for them.
+
 The Parser class is enormous, but is divided into six logical parts.
 
   -- context
-  -- lexical analysis
+  -- token access
   -- module parsing
   -- expression parsing
   -- statement parsing
   -- type expression parsing
 
-As of this writing, the Parser class is ~350 lines long.
+Because the parser walks an index over the token buffer, it can look arbitrarily far ahead (Peek) and backtrack cheaply (Mark and Reset).
+
+A program can also be parsed as a stream: Parser.Statements yields top-level statements as it finishes them, and a TokenBuffer reading from a file only holds on to the tokens of the statement being parsed.
+
+As of this writing, the Parser class is ~300 lines long.
 
   -- About ~150 lines of it is expression parsing.
-  -- About ~100 lines of it is lexical analysis.
 
 """
+import array
 import collections
 
 from . import ast
@@ -73,6 +88,23 @@ KEYWORDS = frozenset([
     'while'
 ])
 
+# Every token type, in the order used to encode them in a TokenBuffer's kinds array.
+TOKEN_TYPES = ('eof', 'str', 'char', 'int', 'float', 'id') + SYMBOLS + tuple(sorted(KEYWORDS))
+
+TOKEN_KIND = dict((type_, kind) for kind, type_ in enumerate(TOKEN_TYPES))
+
+EOF_KIND = TOKEN_KIND['eof']
+
+# SYMBOLS grouped by their first character, longest first, so that the lexer only tries the symbols that could possibly match.
+SYMBOLS_BY_FIRST_CHAR = dict(
+    (c, tuple((symbol, len(symbol), TOKEN_KIND[symbol]) for symbol in SYMBOLS if symbol[0] == c))
+    for c in set(symbol[0] for symbol in SYMBOLS))
+
+MAX_SYMBOL_LENGTH = max(len(symbol) for symbol in SYMBOLS)
+
+# How much of a stream a TokenBuffer reads at a time.
+CHUNK_SIZE = 1 << 16
+
 Token = collections.namedtuple('Token', 'type value')
 
 
@@ -80,144 +112,291 @@ def Parse(string, source):
   return Parser(string, source).Module()
 
 
-class Parser(object):
+class TokenBuffer(object):
+  """Tokens of a c4 program, stored column-wise (see the module docstring).
 
-  ## context
+  The program either comes in whole as a string, or is read from a file-like stream CHUNK_SIZE characters at a time as the parser needs more tokens.
+  For a stream, Release forgets the tokens (and the text) the parser is done with, so memory stays bounded by the size of the largest top-level statement instead of the size of the file.
+  """
 
-  def __init__(self, string, source):
+  def __init__(self, string, source, stream=None):
     self.s = string
     self.src = source
-    self.j = 0
+    self.stream = stream
+    self.streaming = stream is not None
+    self.kinds = array.array('i')
+    self.starts = array.array('i')
+    self.ends = array.array('i')
+    # Where lexing stopped in s, and how many lines came before s (for streams, text is released from the front of s).
     self.i = 0
-    self.peek = self.NextTok()
+    self.lines_released = 0
+    # True once the 'eof' token has been lexed.
+    self.done = False
+    self.Lex()
 
-  @property
-  def done(self):
-    return self.j >= len(self.s)
+  def __len__(self):
+    return len(self.kinds)
 
-  @property
-  def char(self):
-    return self.s[self.i] if self.i < len(self.s) else ''
+  ## location
 
-  @property
-  def lineno(self):
-    return self.s.count('\n', 0, self.j) + 1
+  def Lineno(self, position):
+    return self.lines_released + self.s.count('\n', 0, position) + 1
 
-  @property
-  def colno(self):
-    return self.j - self.s.rfind('\n', 0, self.j)
+  def Colno(self, position):
+    return position - self.s.rfind('\n', 0, position)
 
-  @property
-  def line(self):
-    start = self.s.rfind('\n', 0, self.j) + 1
-    end = self.s.find('\n', self.j)
+  def Line(self, position):
+    start = self.s.rfind('\n', 0, position) + 1
+    end = self.s.find('\n', position)
     end = len(self.s) if end == -1 else end
     return self.s[start:end]
 
-  @property
-  def location_message(self):
+  def LocationMessage(self, position):
     return 'From %s, on line %s\n%s\n%s*\n' % (
-        self.src, self.lineno,
-        self.line,
-        ' ' * (self.colno-1))
+        self.src, self.Lineno(position),
+        self.Line(position),
+        ' ' * (self.Colno(position)-1))
 
-  def Error(self, message):
-    return SyntaxError(self.location_message + message + '\n')
+  def Error(self, message, position):
+    return SyntaxError(self.LocationMessage(position) + message + '\n')
 
-  ## lexical analysis
+  ## streaming
 
-  def SkipSpaces(self):
-    while not self.done and self.char.isspace() or self.char == '#':
-      if self.char == '#':
-        while not self.done and self.char != '\n':
-          self.i += 1
+  def Fill(self, k):
+    # Makes sure token k has been lexed, unless the 'eof' token comes before it.
+    while k >= len(self.kinds) and not self.done:
+      chunk = self.stream.read(CHUNK_SIZE)
+      if chunk:
+        self.s += chunk
       else:
-        self.i += 1
-    self.j = self.i
-
-  def NextTok(self):
-    self.SkipSpaces()
-
-    self.j = self.i
-
-    if self.done:
-      return Token('eof', 'eof')
-
-    # String literal
-    if self.s.startswith(STRING_STARTER + CHAR_STARTER, self.i):
-      type_ = 'str' if self.s.startswith(STRING_STARTER, self.i) else 'char'
-      raw = False
-      if self.char == 'r':
-        raw = True
-        self.i += 1
-      quote = self.s[self.i:self.i+3] if self.s.startswith(('"""', "'''"), self.i) else self.char
-      self.i += len(quote)
-      while not self.s.startswith(quote, self.i):
-        if self.i >= len(self.s):
-          raise self.Error("Finish your quotes!")
-        self.i += 2 if raw and self.char == '\\' else 1
-      self.i += len(quote)
-      return Token(type_, eval(self.s[self.j:self.i]))
-
-    # Symbol
-    symbol_found = False
-    for symbol in SYMBOLS:
-      if self.s.startswith(symbol, self.i):
-        self.i += len(symbol)
-        symbol_found = True
-        return Token(symbol, None)
-
-    # int/float
-    if self.char.isdigit() or (self.char == '.' and self.s[self.i+1:self.i+2].isdigit()):
-      self.j = self.i
-      while self.i < len(self.s) and self.char.isdigit():
-        self.i += 1
-      if self.s.startswith('.', self.i):
-        self.i += 1
-        while self.i < len(self.s) and self.char.isdigit():
-          self.i += 1
-        return Token('float', float(self.s[self.j:self.i]))
+        self.stream = None
+      self.Lex()
+
+  def Release(self, k):
+    """Forgets the tokens before token k, shifting the tokens after them to the front of the buffer.
+
+    The text is released up to the start of the line token k is on, so that error messages can still show that line.
+    Does nothing unless the tokens come from a stream (otherwise the whole program is in memory anyway).
+    Shifting costs as much as the tokens kept, so it is only done once at least half of the tokens can be forgotten.
+    Returns the number of tokens forgotten, i.e. how much the index of every token kept went down by.
+    """
+    if not self.streaming or k == 0 or 2 * k < len(self.kinds):
+      return 0
+    cut = self.s.rfind('\n', 0, self.starts[k]) + 1
+    self.lines_released += self.s.count('\n', 0, cut)
+    self.s = self.s[cut:]
+    self.i -= cut
+    self.kinds = self.kinds[k:]
+    self.starts = array.array('i', [start - cut for start in self.starts[k:]])
+    self.ends = array.array('i', [end - cut for end in self.ends[k:]])
+    return k
+
+  ## lexical analysis
+
+  def Lex(self):
+    # Lexes s from where the last call stopped.
+    # While more of a stream is to come, stops before any token that might continue past the end of s (e.g. 'ab' might turn out to be 'abc', and '<' might be '<<=').
+    s = self.s
+    n = len(s)
+    final = self.stream is None
+    kinds = self.kinds
+    starts = self.starts
+    ends = self.ends
+    i = self.i
+    while True:
+      restart = i
+
+      # Skip spaces and comments.
+      while i < n and (s[i].isspace() or s[i] == '#'):
+        if s[i] == '#':
+          while i < n and s[i] != '\n':
+            i += 1
+        else:
+          i += 1
+
+      j = i
+
+      if i >= n:
+        if final:
+          kinds.append(EOF_KIND)
+          starts.append(n)
+          ends.append(n)
+          self.done = True
+          i = n
+        self.i = i if final else restart
+        return
+
+      c = s[i]
+
+      # String literal
+      if s.startswith(STRING_STARTER + CHAR_STARTER, i):
+        kind = TOKEN_KIND['str' if s.startswith(STRING_STARTER, i) else 'char']
+        raw = False
+        if c == 'r':
+          raw = True
+          i += 1
+        quote = s[i:i+3] if s.startswith(('"""', "'''"), i) else s[i]
+        i += len(quote)
+        while not s.startswith(quote, i):
+          if i >= n:
+            if final:
+              raise self.Error("Finish your quotes!", j)
+            break
+          i += 2 if raw and s[i] == '\\' else 1
+        i += len(quote)
+
+      # Symbol
+      elif c in SYMBOLS_BY_FIRST_CHAR and not (c == '.' and s[i+1:i+2].isdigit()):
+        for symbol, length, kind in SYMBOLS_BY_FIRST_CHAR[c]:
+          if s.startswith(symbol, i):
+            i += length
+            break
+
+      # int/float
+      elif c.isdigit() or c == '.':
+        while i < n and s[i].isdigit():
+          i += 1
+        kind = TOKEN_KIND['int']
+        if s.startswith('.', i):
+          i += 1
+          while i < n and s[i].isdigit():
+            i += 1
+          kind = TOKEN_KIND['float']
+
+      # Identifier
+      elif c in ID_CHARS:
+        while i < n and s[i] in ID_CHARS:
+          i += 1
+        word = s[j:i]
+        kind = TOKEN_KIND[word] if word in KEYWORDS else TOKEN_KIND['id']
+
+      # Unrecognized token.
       else:
-        return Token('int', int(self.s[self.j:self.i]))
+        raise self.Error("I don't know what this token is.", j)
+
+      if not final and (i >= n or j + MAX_SYMBOL_LENGTH > n):
+        self.i = restart
+        return
+
+      kinds.append(kind)
+      starts.append(j)
+      ends.append(i)
+
+  ## token access
+
+  def Type(self, k):
+    return TOKEN_TYPES[self.kinds[k]]
+
+  def Text(self, k):
+    return self.s[self.starts[k]:self.ends[k]]
+
+  def Value(self, k):
+    type_ = TOKEN_TYPES[self.kinds[k]]
+    if type_ in ('str', 'char'):
+      return eval(self.Text(k))
+    elif type_ == 'int':
+      return int(self.Text(k))
+    elif type_ == 'float':
+      return float(self.Text(k))
+    elif type_ == 'id':
+      return self.Text(k)
+    elif type_ == 'eof':
+      return 'eof'
+    else:
+      return None
+
+  def Token(self, k):
+    return Token(self.Type(k), self.Value(k))
+
+
+class Parser(object):
+
+  ## context
 
-    # Identifier
-    if self.char in ID_CHARS:
-      while self.i < len(self.s) and self.char in ID_CHARS:
-        self.i += 1
-      val = self.s[self.j:self.i]
-      type_ = val if val in KEYWORDS else 'id'
-      return Token(type_, val if type_ == 'id' else None)
+  def __init__(self, string, source, stream=None):
+    # With a stream, string is just the start of the program, and the rest is read from the stream.
+    self.src = source
+    self.tokens = TokenBuffer(string, source, stream)
+    self.tokens.Fill(0)
+    self.k = 0
 
-    # Unrecognized token.
-    while self.i < len(self.s) and not self.char.isspace():
-      self.i += 1
+  @property
+  def done(self):
+    return self.tokens.kinds[self.k] == EOF_KIND
 
-    raise self.Error("I don't know what this token is.")
+  @property
+  def j(self):
+    return self.tokens.starts[self.k]
+
+  @property
+  def location_message(self):
+    return self.tokens.LocationMessage(self.j)
+
+  def Error(self, message):
+    return self.tokens.Error(message, self.j)
+
+  ## token access
+
+  @property
+  def peek(self):
+    return self.tokens.Token(self.k)
+
+  def Index(self, offset):
+    # Looking past the end of the buffer keeps on finding the 'eof' token.
+    self.tokens.Fill(self.k + offset)
+    return min(self.k + offset, len(self.tokens) - 1)
+
+  def Peek(self, offset=0):
+    return TOKEN_TYPES[self.tokens.kinds[self.Index(offset)]]
+
+  def PeekValue(self, offset=0):
+    return self.tokens.Value(self.Index(offset))
+
+  def Mark(self):
+    # Marks are only good until the end of the current top-level statement (see Statements).
+    return self.k
+
+  def Reset(self, mark):
+    self.k = mark
 
   def GetTok(self):
-    tok = self.peek
-    self.peek = self.NextTok()
-    return tok
+    # Returns the type of the token consumed.
+    type_ = TOKEN_TYPES[self.tokens.kinds[self.k]]
+    if type_ != 'eof':
+      self.k += 1
+      if self.k >= len(self.tokens):
+        self.tokens.Fill(self.k)
+    return type_
 
   def At(self, *toktype):
-    return self.peek.type in toktype
+    return TOKEN_TYPES[self.tokens.kinds[self.k]] in toktype
 
   def Consume(self, *toktype):
     if self.At(*toktype):
-      return self.GetTok()
+      self.GetTok()
+      return True
+    return False
 
   def Expect(self, *toktype):
+    # Returns the value of the token consumed.
     if not self.At(*toktype):
-      raise self.Error('Expected %s but found %s' % (toktype, self.peek.type))
-    return self.GetTok()
+      raise self.Error('Expected %s but found %s' % (toktype, self.Peek()))
+    value = self.tokens.Value(self.k)
+    self.GetTok()
+    return value
 
   ## module parsing
 
   def Module(self):
-    stmts = []
+    return ast.Module(tuple(self.Statements()))
+
+  def Statements(self):
+    # Yields the top-level statements one at a time, as soon as each is parsed.
+    # The tokens of each statement are released before the next one is parsed, so parsing a stream takes memory proportional to the largest statement, not to the whole program.
     while not self.done:
-      stmts.append(self.Statement())
-    return ast.Module(tuple(stmts))
+      stmt = self.Statement()
+      self.k -= self.tokens.Release(self.k)
+      yield stmt
 
   ## expression parsing
 
@@ -227,15 +406,15 @@ class Parser(object):
 
   def Expression00(self):
     if self.At('id'):
-      return ast.Id(self.Expect('id').value)
+      return ast.Id(self.Expect('id'))
     elif self.At('int'):
-      return ast.Int(self.Expect('int').value)
+      return ast.Int(self.Expect('int'))
     elif self.At('float'):
-      return ast.Float(self.Expect('float').value)
+      return ast.Float(self.Expect('float'))
     elif self.At('str'):
-      return ast.Str(self.Expect('str').value)
+      return ast.Str(self.Expect('str'))
     elif self.At('char'):
-      return ast.Char(self.Expect('char').value)
+      return ast.Char(self.Expect('char'))
     elif self.Consume('('):
       expr = self.Expression()
       self.Expect(')')
@@ -257,18 +436,18 @@ class Parser(object):
         self.Expect(']')
         expr = ast.Subscript(expr, index)
       elif self.At('++', '--'):
-        expr = ast.PostfixOperation(expr, self.GetTok().type)
+        expr = ast.PostfixOperation(expr, self.GetTok())
       elif self.Consume('.'):
-        expr = ast.MemberAccess(expr, self.Expect('id').value)
+        expr = ast.MemberAccess(expr, self.Expect('id'))
       elif self.Consume('->'):
-        expr = ast.MemberAccessThroughPoniter(expr, self.Expect('id').value)
+        expr = ast.MemberAccessThroughPointer(expr, self.Expect('id'))
       else:
         break
     return expr
 
   def Expression02(self):
     if self.At('++', '--', '+', '-', '!', '~', '*', '&'):
-      op = self.GetTok().type
+      op = self.GetTok()
       return ast.PrefixOperation(op, self.Expression02())
     if self.Consume(';sizeof'):
       return ast.SizeofExpression(self.Expression())
@@ -282,70 +461,70 @@ class Parser(object):
   def Expression03(self):
     expr = self.Expression02()
     while self.At('*', '/', '%'):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression02())
     return expr
 
   def Expression04(self):
     expr = self.Expression03()
     while self.At('+', '-'):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression03())
     return expr
 
   def Expression05(self):
     expr = self.Expression04()
     while self.At('<<', '>>'):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression04())
     return expr
 
   def Expression06(self):
     expr = self.Expression05()
     while self.At('<', '<=', '>', '>='):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression05())
     return expr
 
   def Expression07(self):
     expr = self.Expression06()
     while self.At('==', '!='):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression06())
     return expr
 
   def Expression08(self):
     expr = self.Expression07()
     while self.At('&'):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression07())
     return expr
 
   def Expression09(self):
     expr = self.Expression08()
     while self.At('^'):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression08())
     return expr
 
   def Expression10(self):
     expr = self.Expression09()
     while self.At('|'):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression09())
     return expr
 
   def Expression11(self):
     expr = self.Expression10()
     while self.At('&&'):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression10())
     return expr
 
   def Expression12(self):
     expr = self.Expression11()
     while self.At('||'):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression11())
     return expr
 
@@ -360,7 +539,7 @@ class Parser(object):
   def Expression14(self):
     expr = self.Expression13()
     while self.At('=', '+=', '-=', '*=', '/=', '%=', '<<=', '>>=', '&=', '^=', '|='):
-      op = self.GetTok().type
+      op = self.GetTok()
       expr = ast.BinaryOperation(expr, op, self.Expression13())
     return expr
 
@@ -368,9 +547,9 @@ class Parser(object):
 
   def Statement(self):
     if self.Consume(';i'):
-      return ast.Include(self.Expect('char').value)
+      return ast.Include(self.Expect('char'))
     elif self.Consume(';v'):
-      name = ast.Id(self.Expect('id').value)
+      name = ast.Id(self.Expect('id'))
       type_ = self.TypeExpression()
       value = None
       if self.Consume('='):
@@ -378,12 +557,12 @@ class Parser(object):
       self.Expect(';')
       return ast.VariableDeclaration(name, type_, value)
     elif self.Consume(';f'):
-      name = ast.Id(self.Expect('id').value)
+      name = ast.Id(self.Expect('id'))
       type_ = self.TypeExpression()
       body = self.Statement()
       return ast.FunctionDefinition(name, type_, body)
     elif self.Consume(';s'):
-      name = ast.TypeId(self.Expect('id').value)
+      name = ast.TypeId(self.Expect('id'))
       bases = []
       while not self.At('{'):
         bases.append(self.TypeExpression())
@@ -392,13 +571,18 @@ class Parser(object):
     elif self.Consume(';t'):
       args = []
       while not self.At(';f', ';s'):
-        args.append(ast.TypeId(self.Expect('id').value))
+        args.append(ast.TypeId(self.Expect('id')))
       if self.At(';f'):
         return ast.TemplateFunctionDefinition(tuple(args), self.Statement())
       elif self.At(';s'):
         return ast.TemplateStructDefinition(tuple(args), self.Statement())
       else:
         raise SyntaxError(self.peek)
+    elif self.Consume('if'):
+      cond = self.Expression()
+      body = self.Statement()
+      orelse = self.Statement() if self.Consume('else') else None
+      return ast.If(cond, body, orelse)
     elif self.Consume('while'):
       cond = self.Expression()
       body = self.Statement()
@@ -421,7 +605,7 @@ class Parser(object):
 
   def TypeExpression(self):
     if self.At('id'):
-      return ast.TypeId(self.Expect('id').value)
+      return ast.TypeId(self.Expect('id'))
     elif self.Consume('const'):
       return ast.ConstType(self.TypeExpression())
     elif self.Consume('volatile'):
@@ -430,20 +614,20 @@ class Parser(object):
       return ast.PointerType(self.TypeExpression())
     elif self.Consume('['):
       if self.At('int'):
-        index = self.GetTok().value
+        index = self.Expect('int')
         self.Expect(']')
         return ast.ArrayType(self.TypeExpression(), index)
       else:
         args = []
         while not self.Consume(']'):
           args.append(self.TypeExpression())
-        template_name = self.Expect('id').value
+        template_name = self.Expect('id')
         return ast.TemplateType(tuple(args), template_name)
     elif self.Consume('('):
       argnames = []
       argtypes = []
       while not self.Consume(')'):
-        argnames.append(ast.Id(self.Expect('id').value))
+        argnames.append(ast.Id(self.Expect('id')))
         argtypes.append(self.TypeExpression())
         self.Consume(',')
       returns = self.TypeExpression()
@@ -1,3 +1,4 @@
+import io
 import unittest
 
 from . import parser
@@ -38,6 +39,99 @@ class ParseTest(unittest.TestCase):
     )
 
 
+class TokenBufferTest(unittest.TestCase):
+
+  def test_tokens(self):
+    tokens = parser.TokenBuffer("""
+        ;v x int = 0.5;  # comment
+        y->z "s";
+    """, '<unittest>')
+    self.assertEqual(
+        [tokens.Token(k) for k in range(len(tokens))],
+        [
+            parser.Token(';v', None),
+            parser.Token('id', 'x'),
+            parser.Token('id', 'int'),
+            parser.Token('=', None),
+            parser.Token('float', 0.5),
+            parser.Token(';', None),
+            parser.Token('id', 'y'),
+            parser.Token('->', None),
+            parser.Token('id', 'z'),
+            parser.Token('str', 's'),
+            parser.Token(';', None),
+            parser.Token('eof', 'eof'),
+        ])
+
+  def test_offsets(self):
+    tokens = parser.TokenBuffer('while  abc', '<unittest>')
+    self.assertEqual(list(tokens.starts), [0, 7, 10])
+    self.assertEqual(list(tokens.ends), [5, 10, 10])
+    self.assertEqual(tokens.Text(1), 'abc')
+
+  def test_unfinished_quotes(self):
+    with self.assertRaises(SyntaxError):
+      parser.TokenBuffer('x = "abc', '<unittest>')
+
+
+class ParserTokenAccessTest(unittest.TestCase):
+
+  def test_lookahead_and_backtracking(self):
+    p = parser.Parser('a + 1;', '<unittest>')
+    self.assertEqual(p.Peek(3), ';')
+    self.assertEqual(p.Peek(100), 'eof')
+    self.assertEqual(p.PeekValue(2), 1)
+    mark = p.Mark()
+    self.assertEqual(p.Expression(), ast.BinaryOperation(ast.Id('a'), '+', ast.Int(1)))
+    self.assertTrue(p.At(';'))
+    p.Reset(mark)
+    self.assertEqual(p.Expect('id'), 'a')
+
+
+class StreamingTest(unittest.TestCase):
+
+  PROGRAM = """
+      ;i 'stdio.h'
+      # A comment that is long enough to span several chunks.
+      ;f main(argc int, argv **char) int {
+        ;v s *char = \"\"\"a "string"
+        on two lines\"\"\";
+        x <<= 2.5 + abc;
+        return 0;
+      }
+      ;v y int = 1;
+  """
+
+  def setUp(self):
+    self.chunk_size = parser.CHUNK_SIZE
+    parser.CHUNK_SIZE = 3
+
+  def tearDown(self):
+    parser.CHUNK_SIZE = self.chunk_size
+
+  def test_same_as_string(self):
+    self.assertEqual(
+        parser.Parser('', '<unittest>', io.StringIO(self.PROGRAM)).Module(),
+        parser.Parse(self.PROGRAM, '<unittest>'))
+
+  def test_tokens_are_released(self):
+    p = parser.Parser('', '<unittest>', io.StringIO(self.PROGRAM * 20))
+    sizes = []
+    for stmt in p.Statements():
+      sizes.append(len(p.tokens))
+    self.assertEqual(len(sizes), 60)
+    self.assertLess(max(sizes), 100)
+
+  def test_error_line_after_release(self):
+    program = self.PROGRAM * 3 + '\n;v z int = );\n'
+    with self.assertRaises(SyntaxError) as expected:
+      parser.Parse(program, '<unittest>')
+    with self.assertRaises(SyntaxError) as context:
+      list(parser.Parser('', '<unittest>', io.StringIO(program)).Statements())
+    self.assertIn('on line 32\n;v z int = );\n', str(context.exception))
+    self.assertEqual(str(context.exception), str(expected.exception))
+
+
 class CodeGenerationTest(unittest.TestCase):
 
   def test_function_definition(self):
@@ -66,6 +160,47 @@ r"""while (x < 2)
 }
 """)
 
+  def test_if_statement(self):
+    self.assertEqual(
+        parser.Parse("""
+            if x < 2 {
+              x++;
+            } else if x < 4 {
+              x--;
+            } else {
+              x = 0;
+            }
+        """, '<unittest>').str,
+r"""if (x < 2)
+{
+  x++;
+}
+else if (x < 4)
+{
+  x--;
+}
+else
+{
+  x = 0;
+}
+""")
+
+  def test_struct_definition(self):
+    self.assertEqual(
+        parser.Parse("""
+            ;s Point {
+              ;v x int;
+              ;v ys [3]int;
+            }
+        """, '<unittest>').str,
+r"""typedef struct Point Point;
+struct Point
+{
+  int x;
+  int ys[3];
+};
+""")
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,106 @@
+"""profile.py
+
+Reading execution profiles of c4 programs, for profile-guided annotation of the generated C (see ProfileAnnotator in transformer.py).
+
+A profile is read into {C function name: number of calls}. The supported formats are:
+
+  1. the output of c4 --instrument, as CSV or as JSON lines,
+  2. gprof flat profiles (gprof -p, or the flat profile part of plain gprof output),
+  3. gcov output files (.gcov) made with branch probabilities (gcov -b), which have a 'function f called N' line per function, and
+  4. gcov JSON files (gcov --json-format), optionally gzipped (.gcov.json.gz).
+
+The format is detected from the contents of the file.
+Calls are what all of these have in common, so hotness is measured in calls.
+Files with several records for a function (e.g. several runs appended to the same c4 --instrument file) have their calls added up.
+"""
+import csv
+import gzip
+import json
+import re
+
+GCOV_FUNCTION = re.compile(r'^function (\S+) called (\d+)', re.MULTILINE)
+
+
+class ProfileError(Exception):
+  pass
+
+
+def Add(calls, name, count):
+  calls[name] = calls.get(name, 0) + count
+
+
+def ReadInstrumentCsv(string):
+  calls = {}
+  for row in csv.DictReader(string.splitlines()):
+    Add(calls, row['function'], int(row['calls']))
+  return calls
+
+
+def ReadInstrumentJson(string):
+  calls = {}
+  for line in string.splitlines():
+    if line.strip():
+      record = json.loads(line)
+      Add(calls, record['function'], int(record['calls']))
+  return calls
+
+
+def ReadGcovJson(string):
+  calls = {}
+  for file_ in json.loads(string)['files']:
+    for function in file_['functions']:
+      Add(calls, function['name'], int(function['execution_count']))
+  return calls
+
+
+def ReadGcov(string):
+  calls = {}
+  for name, count in GCOV_FUNCTION.findall(string):
+    Add(calls, name, int(count))
+  return calls
+
+
+def ReadGprof(string):
+  """Reads the flat profile, whose rows are: % time, cumulative seconds, self seconds, calls, self ms/call, total ms/call, name.
+
+  Functions without a call count (e.g. functions from libraries that were not compiled with -pg) are left out.
+  """
+  calls = {}
+  lines = iter(string.splitlines())
+  for line in lines:
+    if line.split()[-1:] == ['name'] and 'calls' in line.split():
+      break
+  for line in lines:
+    fields = line.split()
+    if not fields:
+      break
+    if len(fields) >= 7 and fields[3].isdigit():
+      Add(calls, ' '.join(fields[6:]), int(fields[3]))
+  return calls
+
+
+def ParseProfile(string, source='<profile>'):
+  stripped = string.lstrip()
+  try:
+    if stripped.startswith('function,calls'):
+      return ReadInstrumentCsv(stripped)
+    elif stripped.startswith('{') and '"files"' in stripped:
+      return ReadGcovJson(stripped)
+    elif stripped.startswith('{'):
+      return ReadInstrumentJson(stripped)
+    elif 'Flat profile' in string or 'cumulative' in string:
+      return ReadGprof(string)
+    elif GCOV_FUNCTION.search(string):
+      return ReadGcov(string)
+  except (KeyError, ValueError) as e:
+    raise ProfileError('%s: malformed profile (%s)' % (source, e))
+  raise ProfileError('%s: not a profile in any of the supported formats (c4 --instrument, gprof flat profile, gcov -b, gcov JSON)' % source)
+
+
+def ReadProfile(path):
+  """Returns {function name: number of calls} from the profile at path."""
+  with open(path, 'rb') as f:
+    data = f.read()
+  if data[:2] == b'\x1f\x8b':
+    data = gzip.decompress(data) if hasattr(gzip, 'decompress') else gzip.GzipFile(path).read()
+  return ParseProfile(data.decode('utf-8', 'replace'), path)
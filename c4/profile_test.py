@@ -0,0 +1,83 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import profile
+
+GPROF = """Flat profile:
+
+Each sample counts as 0.01 seconds.
+  %   cumulative   self              self     total           
+ time   seconds   seconds    calls  ms/call  ms/call  name    
+ 90.00      0.09     0.09       64     1.41     1.41  fnv1a
+ 10.00      0.10     0.01        1    10.00   100.00  main
+  0.00      0.10     0.00                             __gcov_exit
+
+                        Call graph
+
+granularity: each sample hit covers 4 byte(s) for 10.00% of 0.10 seconds
+
+index % time    self  children    called     name
+                0.09    0.00      64/64          main [2]
+"""
+
+GCOV = """        -:    0:Source:hash.c
+function fnv1a called 64 returned 100% blocks executed 100%
+       64:   10:long fnv1a(char *data, int size)
+function main called 1 returned 100% blocks executed 100%
+function unused called 0 returned 0% blocks executed 0%
+"""
+
+
+class ParseProfileTest(unittest.TestCase):
+
+  def test_instrument_csv(self):
+    string = 'function,calls,seconds\nfib,10,0.5\nmain,1,0.6\nfib,5,0.1\n'
+    self.assertEqual(profile.ParseProfile(string), {'fib': 15, 'main': 1})
+
+  def test_instrument_json(self):
+    string = '{"function": "fib", "calls": 10, "seconds": 0.5}\n{"function": "main", "calls": 1, "seconds": 0.6}\n'
+    self.assertEqual(profile.ParseProfile(string), {'fib': 10, 'main': 1})
+
+  def test_gprof(self):
+    self.assertEqual(profile.ParseProfile(GPROF), {'fnv1a': 64, 'main': 1})
+
+  def test_gcov(self):
+    self.assertEqual(profile.ParseProfile(GCOV), {'fnv1a': 64, 'main': 1, 'unused': 0})
+
+  def test_gcov_json(self):
+    string = json.dumps({'format_version': '1', 'files': [{'file': 'hash.c', 'functions': [
+        {'name': 'fnv1a', 'execution_count': 64},
+        {'name': 'main', 'execution_count': 1},
+    ]}]})
+    self.assertEqual(profile.ParseProfile(string), {'fnv1a': 64, 'main': 1})
+
+  def test_unknown_format(self):
+    with self.assertRaises(profile.ProfileError):
+      profile.ParseProfile('hello world\n')
+
+  def test_malformed(self):
+    with self.assertRaises(profile.ProfileError):
+      profile.ParseProfile('function,calls,seconds\nfib,many,0.5\n')
+
+
+class ReadProfileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_gzipped(self):
+    path = os.path.join(self.directory, 'hash.gcov.json.gz')
+    with gzip.open(path, 'wb') as f:
+      f.write(json.dumps({'files': [{'functions': [{'name': 'fnv1a', 'execution_count': 64}]}]}).encode('utf-8'))
+    self.assertEqual(profile.ReadProfile(path), {'fnv1a': 64})
+
+
+if __name__ == '__main__':
+  unittest.main()
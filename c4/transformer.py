@@ -1,6 +1,84 @@
 """transformer.py
+
+Passes over the ast, and the PassManager that runs them.
+
+A pass is an object with Visit<NodeType> methods, e.g. VisitFunctionDefinition.
+The PassManager, not the pass, walks the tree, calling each pass's method for every node of the matching type (parents before children).
+That way, consecutive passes that don't depend on each other share a single walk of the tree instead of costing one walk each.
+
+A pass lists the names of the passes whose results it needs in 'requires'.
+A required pass must run earlier in the pipeline, and must have finished with the whole tree before the requiring pass sees any node, so the two are never fused into the same walk.
+A pass that can't be expressed as per-node visits (e.g. one that needs to see children before parents) sets 'fusable' to False and overrides Run; it always gets a walk of its own.
+Begin and End are called on every pass, fusable or not, once before and once after the whole module.
 """
+import os
+import timeit
+
 from . import ast
+from . import evaluator
+from . import parser
+
+# Where TemplateExpander looks for templates that a module uses but does not define.
+LIBRARY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')
+
+
+def Children(node):
+  for attribute in node.attributes:
+    child = getattr(node, attribute)
+    if isinstance(child, ast.Tree):
+      yield child
+    elif isinstance(child, tuple):
+      for c in child:
+        if isinstance(c, ast.Tree):
+          yield c
+
+
+def Rebuild(node, rewrite):
+  """Applies rewrite to every tree in node, children before parents, and returns the result.
+
+  rewrite(tree) returns either tree itself or its replacement.
+  Nodes with nothing replaced underneath are returned as is, so they keep their generated code cache.
+  Like Walk, this does not recurse, so very deep trees (e.g. long operator chains) are fine.
+  """
+  # Stack entries are (node, None) before node's children are pushed, and (node, number of children) after.
+  # Rebuilt nodes go on 'done', so a node's rebuilt children are the last entries of 'done' by the time it comes up again.
+  done = []
+  stack = [(node, None)]
+  while stack:
+    node, count = stack.pop()
+    if count is None:
+      children = tuple(Children(node))
+      stack.append((node, len(children)))
+      stack.extend((child, None) for child in reversed(children))
+      continue
+    new_children = iter(done[len(done) - count:])
+    del done[len(done) - count:]
+    changes = {}
+    for attribute in node.attributes:
+      child = getattr(node, attribute)
+      if isinstance(child, ast.Tree):
+        new_child = next(new_children)
+      elif isinstance(child, tuple):
+        new_child = tuple(next(new_children) if isinstance(c, ast.Tree) else c for c in child)
+        if all(a is b for a, b in zip(new_child, child)):
+          new_child = child
+      else:
+        continue
+      if new_child is not child:
+        changes[attribute] = new_child
+    if changes:
+      node = node.Copy(**changes)
+    done.append(rewrite(node))
+  return done[0]
+
+
+def Walk(node):
+  """Yields node and all its descendants, parents before children."""
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    yield node
+    stack.extend(reversed(tuple(Children(node))))
 
 
 class Visitor(object):
@@ -13,20 +91,1017 @@ class Visitor(object):
       return self.GenericVisit(node)
 
   def GenericVisit(self, node):
-    for attribute in node.attributes:
-      child = getattr(node, attribute)
-      if isinstance(node, ast.Tree):
-        self.Visit(child)
-      elif isinstance(child, tuple):
-        for c in child:
-          if isinstance(c, ast.Tree):
-            self.Visit(c)
+    for child in Children(node):
+      self.Visit(child)
+
+
+class Pass(object):
+  requires = ()
+  fusable = True
+
+  @property
+  def name(self):
+    return type(self).__name__
+
+  def Begin(self, module):
+    pass
+
+  def End(self, module):
+    pass
+
+  def Run(self, module):
+    # Only called for passes that are not fusable.
+    raise NotImplementedError(self.name + ' is not fusable, so it must implement Run')
+
+  def Prologue(self):
+    # C code that has to come first in every translation unit the module ends up in, before any include (e.g. feature test macros).
+    return ''
+
+
+class PassManager(object):
+  """Runs an ordered list of passes over a module.
+
+  Run takes the whole module at once.
+  Stream takes an iterable of top-level statements (e.g. Parser.Statements()) and yields the transformed top-level statements, running all the passes on each statement before moving on to the next.
+  With Stream, every pass sees one statement at a time (in a Module of its own), and Begin and End are called with None as the module, so passes must keep whatever they need to know about earlier statements.
+
+  After Run or Stream, the following are available:
+
+    seconds      -- {pass name: seconds spent in the pass}, which for fusable passes only includes their visits with time_visitors
+    nodes        -- {pass name: number of nodes the pass visited} (always 0 for passes that are not fusable)
+    walks        -- list of tuples of the pass names that share each walk of the tree
+    walk_seconds -- list of the seconds spent in each walk, visits included
+
+  Timing every visit costs two clock reads per visit, which on large trees can cost more than fusing saves, so it is off unless time_visitors is True.
+  """
+
+  def __init__(self, passes, time_visitors=False):
+    self.passes = tuple(passes)
+    self.time_visitors = time_visitors
+    names = [pass_.name for pass_ in self.passes]
+    for index, pass_ in enumerate(self.passes):
+      if names.count(pass_.name) > 1:
+        raise ValueError('Pass %s appears more than once' % pass_.name)
+      for required in pass_.requires:
+        if required not in names[:index]:
+          raise ValueError('Pass %s requires %s, which does not run before it' % (pass_.name, required))
+    self.groups = self.Fuse(self.passes)
+    self.walks = [tuple(pass_.name for pass_ in group) for group in self.groups]
+    self.seconds = {}
+    self.nodes = {}
+    self.walk_seconds = []
+
+  @staticmethod
+  def Fuse(passes):
+    groups = []
+    group = []
+    for pass_ in passes:
+      if group and (not pass_.fusable or not group[-1].fusable or any(p.name in pass_.requires for p in group)):
+        groups.append(tuple(group))
+        group = []
+      group.append(pass_)
+    if group:
+      groups.append(tuple(group))
+    return groups
+
+  def Run(self, module):
+    self.Begin(module)
+    module = self.RunGroups(module)
+    self.End(module)
+    return module
+
+  def Stream(self, statements):
+    self.Begin(None)
+    for stmt in statements:
+      for new_stmt in self.RunGroups(ast.Module((stmt,))).statements:
+        yield new_stmt
+    self.End(None)
+
+  def Prologue(self):
+    return ''.join(pass_.Prologue() for pass_ in self.passes)
+
+  def Begin(self, module):
+    self.seconds = dict((pass_.name, 0.0) for pass_ in self.passes)
+    self.nodes = dict((pass_.name, 0) for pass_ in self.passes)
+    self.walk_seconds = [0.0] * len(self.groups)
+    # For each group, {node type: ((pass name, visit method), ...)}
+    self.dispatches = [{} for group in self.groups]
+    for pass_ in self.passes:
+      start = timeit.default_timer()
+      pass_.Begin(module)
+      self.seconds[pass_.name] += timeit.default_timer() - start
+
+  def End(self, module):
+    for pass_ in self.passes:
+      start = timeit.default_timer()
+      pass_.End(module)
+      self.seconds[pass_.name] += timeit.default_timer() - start
+
+  def RunGroups(self, module):
+    for index, (group, dispatch) in enumerate(zip(self.groups, self.dispatches)):
+      start = timeit.default_timer()
+      if group[0].fusable:
+        self.RunFused(group, dispatch, module)
+      else:
+        module = group[0].Run(module)
+        self.seconds[group[0].name] += timeit.default_timer() - start
+      self.walk_seconds[index] += timeit.default_timer() - start
+    return module
+
+  def RunFused(self, group, dispatch, module):
+    timer = timeit.default_timer
+    seconds = self.seconds
+    # {node type: number of nodes of that type}, added to the passes' node counts after the walk.
+    visited = {}
+    for node in Walk(module):
+      type_ = type(node)
+      if type_ not in dispatch:
+        method_name = 'Visit' + type_.__name__
+        dispatch[type_] = tuple((pass_.name, getattr(pass_, method_name)) for pass_ in group if hasattr(pass_, method_name))
+      methods = dispatch[type_]
+      if not methods:
+        continue
+      visited[type_] = visited.get(type_, 0) + 1
+      if self.time_visitors:
+        for name, method in methods:
+          start = timer()
+          method(node)
+          seconds[name] += timer() - start
+      else:
+        for _, method in methods:
+          method(node)
+    for type_, count in visited.items():
+      for name, _ in dispatch[type_]:
+        self.nodes[name] += count
+
+  def Report(self):
+    lines = ['%-24s %10s %8s' % ('pass', 'seconds', 'nodes')]
+    for pass_ in self.passes:
+      lines.append('%-24s %10.6f %8d' % (pass_.name, self.seconds[pass_.name], self.nodes[pass_.name]))
+    lines.append('%d walk(s) per tree:' % len(self.walks))
+    for walk, seconds in zip(self.walks, self.walk_seconds):
+      lines.append('%-24s %10.6f' % (', '.join(walk), seconds))
+    if not self.time_visitors:
+      lines.append('(visits are only timed per walk; time them per pass with time_visitors)')
+    return '\n'.join(lines) + '\n'
+
+
+class TargetAbi(object):
+  """Sizes and alignments of C types on a target, for estimating struct layouts.
+
+  scalars maps type names (as they appear in a TypeId) to (size, alignment) in bytes.
+  pointer is the (size, alignment) of every pointer type.
+  """
+
+  def __init__(self, name, pointer, scalars):
+    self.name = name
+    self.pointer = pointer
+    self.scalars = scalars
+
+  def SizeAndAlignment(self, type_, structs):
+    """Returns the (size, alignment) of type_, or None if it is not known.
+
+    structs maps the names of the structs defined so far to their (size, alignment).
+    """
+    if isinstance(type_, ast.TypeId):
+      return self.scalars.get(type_.value) or structs.get(type_.value)
+    elif isinstance(type_, ast.PointerType):
+      return self.pointer
+    elif isinstance(type_, ast.ArrayType):
+      element = self.SizeAndAlignment(type_.type, structs)
+      return element and (element[0] * type_.count, element[1])
+    elif isinstance(type_, (ast.ConstType, ast.VolatileType)):
+      return self.SizeAndAlignment(type_.type, structs)
+    else:
+      return None
+
+
+def FixedWidthScalars(long_):
+  scalars = {
+      'char': (1, 1), 'short': (2, 2), 'int': (4, 4), 'long': long_,
+      'float': (4, 4), 'double': (8, 8),
+      'int8_t': (1, 1), 'int16_t': (2, 2), 'int32_t': (4, 4), 'int64_t': (8, 8),
+      'uint8_t': (1, 1), 'uint16_t': (2, 2), 'uint32_t': (4, 4), 'uint64_t': (8, 8),
+  }
+  for name in ('size_t', 'ssize_t', 'ptrdiff_t', 'intptr_t', 'uintptr_t'):
+    scalars[name] = long_
+  return scalars
+
+
+X86_64_SYSV = TargetAbi('x86-64-sysv', (8, 8), FixedWidthScalars((8, 8)))
+
+I386_SYSV = TargetAbi('i386-sysv', (4, 4), dict(FixedWidthScalars((4, 4)), double=(8, 4), int64_t=(8, 4), uint64_t=(8, 4)))
+
+TARGET_ABIS = dict((abi.name, abi) for abi in (X86_64_SYSV, I386_SYSV))
+
+# Structs listing this as a base are never reordered, e.g. because their layout has to match a file format or a wire protocol.
+#   ;s Header layout_sensitive { ... }
+LAYOUT_SENSITIVE = 'layout_sensitive'
+
+
+def StructLayout(fields):
+  """Returns (size, alignment, padding) of a struct with fields [(size, alignment), ...] in that order."""
+  offset = 0
+  alignment = 1
+  padding = 0
+  for field_size, field_alignment in fields:
+    pad = -offset % field_alignment
+    padding += pad
+    offset += pad + field_size
+    alignment = max(alignment, field_alignment)
+  pad = -offset % alignment
+  return offset + pad, alignment, padding + pad
+
+
+class StructFieldReorderer(Pass):
+  """Reorders struct fields to minimize padding, or with reorder=False, only reports the wasted bytes.
+
+  Fields are sorted by decreasing alignment, keeping source order among fields with the same alignment.
+  Structs marked LAYOUT_SENSITIVE, structs named in skip, and structs with a field of unknown size are left alone.
+  After Run, messages holds a line for every struct that wastes bytes on padding.
+  """
+
+  def __init__(self, abi=X86_64_SYSV, reorder=True, skip=()):
+    self.abi = abi
+    self.reorder = reorder
+    self.skip = frozenset(skip)
+    self.messages = []
+    self.structs = {}
+
+  def Begin(self, module):
+    self.messages = []
+    self.structs = {}
+
+  def VisitStructDefinition(self, node):
+    name = node.name.value
+    fields = node.body.statements
+    layouts = [self.abi.SizeAndAlignment(field.type, self.structs) if isinstance(field, ast.VariableDeclaration) else None for field in fields]
+    if None in layouts:
+      return
+    size, alignment, padding = StructLayout(layouts)
+    self.structs[name] = (size, alignment)
+
+    if padding == 0 or name in self.skip or ast.TypeId(LAYOUT_SENSITIVE) in node.bases:
+      return
+    order = sorted(range(len(fields)), key=lambda i: -layouts[i][1])
+    _, _, new_padding = StructLayout([layouts[i] for i in order])
+    if new_padding == padding:
+      self.messages.append('struct %s wastes %d of %d bytes on padding (%s)' % (name, padding, size, self.abi.name))
+    elif self.reorder:
+      # Passes run before any code is generated, so there is no generated code cache to invalidate.
+      node.body = node.body.Copy(statements=tuple(fields[i] for i in order))
+      self.structs[name] = (size - padding + new_padding, alignment)
+      self.messages.append('struct %s: reordered fields, padding %d -> %d bytes (%s)' % (name, padding, new_padding, self.abi.name))
+    else:
+      self.messages.append('struct %s wastes %d of %d bytes on padding, %d with fields reordered as %s (%s)' % (
+          name, padding, size, new_padding, ', '.join(fields[i].name.value for i in order), self.abi.name))
+
+
+# Declaration specifiers for the functions the language passes generate (template instances and their preludes, struct-of-arrays helpers).
+# With internal linkage, every C file that uses e.g. [int]vector gets its own copy of its functions, so separately compiled files link together.
+# A file rarely uses all of them, so they are also marked as possibly unused, which keeps gcc -Wall quiet.
+PRIVATE = ('static', 'C4_UNUSED')
+
+UNUSED_MACRO = ast.Verbatim("""#ifndef C4_UNUSED
+#ifdef __GNUC__
+#define C4_UNUSED __attribute__((unused))
+#else
+#define C4_UNUSED
+#endif
+#endif
+""")
+
+
+def Private(function):
+  """Returns a copy of the FunctionDeclaration or FunctionDefinition function, with internal linkage."""
+  function = function.Copy()
+  function.specifiers = PRIVATE + (function.specifiers or ())
+  return function
+
+
+# Structs listing this as a base also get a struct-of-arrays counterpart, see StructOfArrays.
+#   ;s Particle soa { ... }
+SOA = 'soa'
+
+# The struct-of-arrays counterpart of struct %(name)s, in c4.
+# The %(...)s placeholders that hold per-field code are filled in once for every field, with C4_SOA_FIELD<k> standing for the type of the k-th field.
+SOA_SOURCE = """
+;s %(soa)s {
+%(fields)s
+  ;v size size_t;
+  ;v capacity size_t;
+}
+
+;f %(soa)s_init(v *%(soa)s) void {
+%(init)s
+  v->size = 0;
+  v->capacity = 0;
+}
+
+;f %(soa)s_free(v *%(soa)s) void {
+%(free)s
+  %(soa)s_init(v);
+}
+
+;f %(soa)s_reserve(v *%(soa)s, capacity size_t) void {
+  if capacity > v->capacity {
+%(reserve)s
+    v->capacity = capacity;
+  }
+}
+
+;f %(soa)s_resize(v *%(soa)s, size size_t) void {
+  %(soa)s_reserve(v, size);
+  v->size = size;
+}
+
+;f %(soa)s_get(v *%(soa)s, i size_t) %(name)s {
+  ;v value %(name)s;
+%(get)s
+  return value;
+}
+
+;f %(soa)s_set(v *%(soa)s, i size_t, value %(name)s) void {
+%(set)s
+}
+
+;f %(soa)s_push(v *%(soa)s, value %(name)s) void {
+  if v->size == v->capacity {
+    %(soa)s_reserve(v, v->capacity ? 2 * v->capacity : 8);
+  }
+  %(soa)s_set(v, v->size++, value);
+}
+"""
+
+SOA_FIELD_SOURCE = {
+    'fields': ';v %(field)s *%(type)s;',
+    'init': 'v->%(field)s = 0;',
+    'free': 'free(v->%(field)s);',
+    'reserve': 'v->%(field)s = realloc(v->%(field)s, capacity * sizeof(%(type)s)); if !v->%(field)s { abort(); }',
+    'get': 'value.%(field)s = v->%(field)s[i];',
+    'set': 'v->%(field)s[i] = value.%(field)s;',
+}
+
+
+class StructOfArrays(Pass):
+  """Gives every struct marked SOA a struct-of-arrays counterpart, and rewrites element accesses to use it.
+
+  For ;s Particle soa { ;v x float; ;v y float; }, the struct Particle is kept as is, and is followed by
+
+    Particle_soa                   -- a struct with a pointer for every field (float *x, float *y), and size and capacity,
+    Particle_soa_init(v)           -- makes v empty,
+    Particle_soa_free(v)           -- frees v's arrays, and makes v empty,
+    Particle_soa_reserve(v, n)     -- makes room for n elements,
+    Particle_soa_resize(v, n)      -- makes room for n elements, and sets the size to n (the new elements are not initialized),
+    Particle_soa_get(v, i)         -- gathers element i into a Particle,
+    Particle_soa_set(v, i, p)      -- scatters the Particle p into element i, and
+    Particle_soa_push(v, p)        -- appends the Particle p.
+
+  Inside functions, xs[i].x becomes xs.x[i] for every variable or argument xs of type Particle_soa, and xs->x[i] if xs has type *Particle_soa.
+  Code that loops over one or two fields then reads only those fields' arrays, with unit stride, which uses memory bandwidth well and leaves loops the compiler can vectorize.
+  Variables are recognized by name: a local that shadows one of a different type hides it from the whole function.
+  Using a whole element (xs[i] without a field) is an error; use the _get and _set functions instead.
+  With private True, the Particle_soa_* functions are static (see PRIVATE).
+  """
+  fusable = False
+
+  def __init__(self, private=True):
+    self.private = private
+
+  def Begin(self, module):
+    self.structs = {}
+    self.globals = {}
+    self.includes = set()
+    self.emitted_unused_macro = False
+
+  def Run(self, module):
+    output = []
+    changed = False
+    for stmt in module.statements:
+      output.append(stmt)
+      if isinstance(stmt, ast.Include):
+        self.includes.add(stmt.path)
+      elif isinstance(stmt, ast.StructDefinition) and ast.TypeId(SOA) in stmt.bases:
+        output.extend(self.Generate(stmt))
+        changed = True
+      elif isinstance(stmt, ast.VariableDeclaration):
+        self.Declare(self.globals, stmt.name.value, stmt.type)
+      elif isinstance(stmt, ast.FunctionDefinition):
+        output[-1] = self.RewriteFunction(stmt)
+        changed = changed or output[-1] is not stmt
+    return module.Copy(statements=tuple(output)) if changed else module
+
+  def Generate(self, struct):
+    name = struct.name.value
+    fields = struct.body.statements
+    if name in self.structs:
+      # The same struct may come from several modules of a unity build, but its counterpart must be generated once.
+      if self.structs[name] != struct:
+        raise ValueError('struct %s is defined differently in different modules' % name)
+      return []
+    for field in fields:
+      if not isinstance(field, ast.VariableDeclaration) or isinstance(field.type, ast.ArrayType):
+        raise ValueError('struct %s is marked %s, so its fields must be plain variables, but %s is not' % (name, SOA, field.Str(0).strip()))
+    self.structs[name] = struct
+    types = dict(('C4_SOA_FIELD%d' % index, field.type) for index, field in enumerate(fields))
+    source = SOA_SOURCE % dict(
+        [('name', name), ('soa', name + '_soa')] +
+        [(key, '\n'.join('  ' + line % {'field': field.name.value, 'type': 'C4_SOA_FIELD%d' % index} for index, field in enumerate(fields)))
+         for key, line in SOA_FIELD_SOURCE.items()])
+    statements = parser.Parse(source, '<%s soa>' % name).statements
+    statements = [Rebuild(stmt, lambda node: types.get(node.value, node) if isinstance(node, ast.TypeId) else node) for stmt in statements]
+    if self.private:
+      statements = [Private(stmt) if isinstance(stmt, ast.FunctionDefinition) else stmt for stmt in statements]
+      if not self.emitted_unused_macro:
+        self.emitted_unused_macro = True
+        statements.insert(0, UNUSED_MACRO)
+    if 'stdlib.h' not in self.includes:
+      self.includes.add('stdlib.h')
+      statements.insert(0, ast.Include('stdlib.h'))
+    return statements
+
+  def SoaStruct(self, type_):
+    """Returns (struct name, whether type_ is a pointer) if type_ is a struct-of-arrays type or a pointer to one, and None otherwise."""
+    pointer = isinstance(type_, ast.PointerType)
+    if pointer:
+      type_ = type_.pointee
+    if isinstance(type_, ast.TypeId) and type_.value.endswith('_soa') and type_.value[:-len('_soa')] in self.structs:
+      return type_.value[:-len('_soa')], pointer
+    return None
+
+  def Declare(self, variables, name, type_):
+    soa = self.SoaStruct(type_)
+    if soa:
+      variables[name] = soa
+    else:
+      variables.pop(name, None)
+
+  def RewriteFunction(self, function):
+    if not self.structs:
+      return function
+    variables = dict(self.globals)
+    if isinstance(function.type, ast.FunctionType):
+      for name, type_ in zip(function.type.argument_names, function.type.argument_types):
+        self.Declare(variables, name.value, type_)
+    for node in Walk(function.body):
+      if isinstance(node, ast.VariableDeclaration):
+        self.Declare(variables, node.name.value, node.type)
+    if not variables:
+      return function
+
+    def RewriteAccess(node):
+      # xs[i].f -> xs.f[i]
+      if not (isinstance(node, ast.MemberAccess) and isinstance(node.expression, ast.Subscript) and
+              isinstance(node.expression.subscriptable, ast.Id) and node.expression.subscriptable.value in variables):
+        return node
+      xs = node.expression.subscriptable
+      struct, pointer = variables[xs.value]
+      if not any(field.name.value == node.attribute for field in self.structs[struct].body.statements):
+        raise ValueError('struct %s has no field %s (in %s)' % (struct, node.attribute, function.name.value))
+      access = ast.MemberAccessThroughPointer(xs, node.attribute) if pointer else ast.MemberAccess(xs, node.attribute)
+      return ast.Subscript(access, node.expression.index)
+
+    body = Rebuild(function.body, RewriteAccess)
+    for node in Walk(body):
+      if isinstance(node, ast.Subscript) and isinstance(node.subscriptable, ast.Id) and node.subscriptable.value in variables:
+        struct, _ = variables[node.subscriptable.value]
+        raise ValueError('%s is a struct of arrays, so its elements can only be used field by field (%s[i].field); use %s_soa_get and %s_soa_set for whole elements (in %s)' % (
+            node.subscriptable.value, node.subscriptable.value, struct, struct, function.name.value))
+    return function.Copy(body=body) if body is not function.body else function
 
 
 class TypeAnnotator(object):
   pass
 
 
-class TemplateExpander(object):
-  pass
+def Mangle(type_):
+  """Spells type_ as an identifier, for naming template instances, e.g. *char -> ptr_char."""
+  if isinstance(type_, ast.TypeId):
+    return type_.value
+  elif isinstance(type_, ast.PointerType):
+    return 'ptr_' + Mangle(type_.pointee)
+  elif isinstance(type_, ast.ConstType):
+    return 'const_' + Mangle(type_.type)
+  elif isinstance(type_, ast.VolatileType):
+    return 'volatile_' + Mangle(type_.type)
+  elif isinstance(type_, ast.ArrayType):
+    return 'array%s_%s' % (type_.count, Mangle(type_.type))
+  else:
+    raise ValueError("Can't use %r as a template argument" % (type_,))
+
+
+# A template calls <parameter>_<hook>, e.g. K_hash(key) in [K V]map, for the operations its arguments must provide.
+TEMPLATE_HOOKS = ('hash', 'equal')
+
+
+class TemplateFamily(object):
+  """A template struct, together with the template functions that operate on it.
+
+  A template function belongs to the family of template struct 'name' if its own name starts with 'name_'.
+  Using [args]name anywhere instantiates the whole family with args.
+  In the instance [int]vector of family vector,
+
+    -- the struct is renamed vector_int,
+    -- function vector_push is renamed vector_int_push (also where it is called from inside the family),
+    -- the template argument T is replaced by int, and
+    -- calls to the hooks T_hash and T_equal become calls to int_hash and int_equal (see TEMPLATE_HOOKS).
+    Other identifiers, such as a global T_MAX, are left alone.
+
+  prelude holds the non-template statements (includes, helper functions) of the file the family was defined in.
+  They are emitted once, before the first instance of any family from that file.
+  """
+
+  def __init__(self, struct, functions, prelude, path):
+    self.struct = struct
+    self.functions = functions
+    self.prelude = prelude
+    self.path = path
+
+  @property
+  def name(self):
+    return self.struct.struct_definition.name.value
+
+  @property
+  def parameters(self):
+    return tuple(argument.value for argument in self.struct.arguments)
+
+
+def IsTemplate(stmt):
+  return isinstance(stmt, (ast.TemplateStructDefinition, ast.TemplateFunctionDefinition))
+
+
+def Families(statements, prelude, path):
+  structs = [stmt for stmt in statements if isinstance(stmt, ast.TemplateStructDefinition)]
+  functions = [stmt for stmt in statements if isinstance(stmt, ast.TemplateFunctionDefinition)]
+  families = {}
+  for struct in structs:
+    name = struct.struct_definition.name.value
+    members = tuple(function for function in functions if function.function_definition.name.value.startswith(name + '_'))
+    for function in members:
+      if len(function.arguments) != len(struct.arguments):
+        raise ValueError('Template function %s takes %d arguments, but template struct %s takes %d' % (
+            function.function_definition.name.value, len(function.arguments), name, len(struct.arguments)))
+    families[name] = TemplateFamily(struct, members, prelude, path)
+  return families
+
+
+def LanguagePasses(private=True):
+  """Returns the passes that implement parts of the c4 language itself, which run before any other pass.
+
+  With private False, the functions they generate keep external linkage, for a unity build that has one copy of them for the whole program.
+  """
+  return [TemplateExpander(private=private), StructOfArrays(private=private), CompileTimeEvaluator()]
+
+
+class TemplateExpander(Pass):
+  """Replaces every use of a template type with a specialized instance of the template, and removes the template definitions.
+
+  Templates are looked up first in the module itself, and then in the c4 template library (c4/lib/<name>.c4), which provides
+
+    [T]vector   -- a growable array,
+    [T]ring     -- a growable ring buffer, and
+    [K V]map    -- an open addressing hash map.
+
+  See TemplateFamily for how instances are named.
+  The code for an instance goes right before the first top-level statement that uses it, with prototypes for all its functions first, so that the functions may call each other in any order.
+  With private True, the functions of instances and of preludes are static (see PRIVATE).
+  """
+  fusable = False
+
+  def __init__(self, library=LIBRARY_DIRECTORY, private=True):
+    self.library = library
+    self.library_families = {}
+    self.private = private
+
+  def LibraryFamily(self, name):
+    if name not in self.library_families:
+      path = os.path.join(self.library, name + '.c4')
+      if not os.path.exists(path):
+        self.library_families[name] = None
+      else:
+        with open(path) as f:
+          statements = parser.Parse(f.read(), path).statements
+        prelude = tuple(stmt for stmt in statements if not IsTemplate(stmt))
+        self.library_families.update(Families(statements, prelude, path))
+        self.library_families.setdefault(name, None)
+    return self.library_families[name]
+
+  def Begin(self, module):
+    # When streaming (module is None), the module's templates become known as they go by, so they have to be defined before they are used.
+    statements = module.statements if module is not None else ()
+    self.templates = [stmt for stmt in statements if IsTemplate(stmt)]
+    # A module's own templates have no prelude: the rest of the module is emitted anyway.
+    self.families = Families(self.templates, (), None)
+    self.instances = set()
+    self.emitted_preludes = set()
+    self.emitted_unused_macro = False
+    self.includes = set(stmt.path for stmt in statements if isinstance(stmt, ast.Include))
+
+  def End(self, module):
+    # Checked at the end, since when streaming, a family's struct may come after its functions.
+    members = set(id(function) for family in self.families.values() for function in family.functions)
+    for stmt in self.templates:
+      if isinstance(stmt, ast.TemplateFunctionDefinition) and id(stmt) not in members:
+        name = stmt.function_definition.name.value
+        raise ValueError('Template function %s belongs to no template struct (the functions of template struct s are named s_*), so it can never be instantiated' % name)
+
+  def Run(self, module):
+    self.output = []
+    changed = False
+    for stmt in module.statements:
+      if IsTemplate(stmt):
+        if not any(stmt is template for template in self.templates):
+          self.templates.append(stmt)
+          self.families = Families(self.templates, (), None)
+        changed = True
+        continue
+      if isinstance(stmt, ast.Include):
+        self.includes.add(stmt.path)
+      new_stmt = Rebuild(stmt, self.ExpandTemplateType)
+      changed = changed or new_stmt is not stmt
+      self.output.append(new_stmt)
+    return module.Copy(statements=tuple(self.output)) if changed else module
+
+  def ExpandTemplateType(self, node):
+    if isinstance(node, ast.TemplateType):
+      return ast.TypeId(self.Instantiate(node))
+    return node
+
+  def Instantiate(self, template_type):
+    # Returns the name of the instance, generating its code if this is its first use.
+    family = self.families.get(template_type.name) or self.LibraryFamily(template_type.name)
+    if family is None:
+      raise ValueError('No template named %s (looked in the module and in %s)' % (template_type.name, self.library))
+    if len(template_type.arguments) != len(family.parameters):
+      raise ValueError('Template %s takes %d arguments, but found %d' % (family.name, len(family.parameters), len(template_type.arguments)))
+
+    instance = '_'.join((family.name,) + tuple(Mangle(argument) for argument in template_type.arguments))
+    if instance in self.instances:
+      return instance
+    # Registered before generating the code, since the family refers to its own instance (e.g. in 'v *[T]vector').
+    self.instances.add(instance)
+    if self.private and not self.emitted_unused_macro:
+      self.emitted_unused_macro = True
+      self.output.append(UNUSED_MACRO)
+
+    if family.path not in self.emitted_preludes:
+      self.emitted_preludes.add(family.path)
+      for stmt in family.prelude:
+        if isinstance(stmt, ast.Include):
+          if stmt.path in self.includes:
+            continue
+          self.includes.add(stmt.path)
+        elif isinstance(stmt, ast.FunctionDefinition) and self.private:
+          stmt = Private(stmt)
+        self.output.append(stmt)
+
+    bindings = dict(zip(family.parameters, template_type.arguments))
+    hooks = dict(('%s_%s' % (parameter, hook), '%s_%s' % (Mangle(argument), hook))
+                 for parameter, argument in bindings.items() for hook in TEMPLATE_HOOKS)
+    renames = dict((function.function_definition.name.value, instance + function.function_definition.name.value[len(family.name):]) for function in family.functions)
+
+    def Substitute(node):
+      if isinstance(node, ast.TypeId) and node.value in bindings:
+        return bindings[node.value]
+      elif isinstance(node, ast.Id):
+        if node.value in renames:
+          return ast.Id(renames[node.value])
+        if node.value in hooks:
+          return ast.Id(hooks[node.value])
+      elif isinstance(node, ast.TemplateType):
+        return self.ExpandTemplateType(node)
+      return node
+
+    struct = Rebuild(family.struct.struct_definition, Substitute).Copy(name=ast.TypeId(instance))
+    functions = [Rebuild(function.function_definition, Substitute) for function in family.functions]
+    prototypes = [ast.FunctionDeclaration(function.name.value, function.type) for function in functions]
+    if self.private:
+      functions = [Private(function) for function in functions]
+      prototypes = [Private(prototype) for prototype in prototypes]
+    self.output.append(struct)
+    self.output.extend(prototypes)
+    self.output.extend(functions)
+    return instance
+
+
+# Global initializers that call this are evaluated at translation time, see CompileTimeEvaluator.
+#   ;v crc_table [256]long = compile_time(crc);
+COMPILE_TIME = 'compile_time'
+
+
+def IsCompileTime(expr):
+  return isinstance(expr, ast.FunctionCall) and expr.function == ast.Id(COMPILE_TIME)
+
+
+class CompileTimeEvaluator(Pass):
+  """Evaluates the initializers of global variables marked with COMPILE_TIME, and replaces them with literals.
+
+    ;v table [256]long = compile_time(crc);     -- {crc(0), crc(1), ..., crc(255)}
+    ;v grid [4][8]double = compile_time(f);     -- {{f(0, 0), ..., f(0, 7)}, ..., {f(3, 0), ..., f(3, 7)}}
+    ;v tau double = compile_time(8 * atan(1));  -- any expression, for a variable that is not an array
+
+  So a table is computed once, by the transpiler, instead of at the start of every run of the program.
+  The functions used must be pure functions over numbers, defined earlier in the module (or math.h functions); see evaluator.py for what can be evaluated, and for the limits on each initializer.
+  The functions are still emitted, so the program may call them at run time too.
+  Anywhere else, compile_time is just an undefined function, which the C compiler reports.
+  """
+  fusable = False
+
+  def __init__(self, max_steps=evaluator.DEFAULT_MAX_STEPS, max_memory=evaluator.DEFAULT_MAX_MEMORY, max_depth=evaluator.DEFAULT_MAX_DEPTH):
+    self.max_steps = max_steps
+    self.max_memory = max_memory
+    self.max_depth = max_depth
+    self.functions = {}
+
+  def Begin(self, module):
+    self.functions = {}
+
+  def Run(self, module):
+    output = []
+    changed = False
+    for stmt in module.statements:
+      if isinstance(stmt, ast.FunctionDefinition):
+        self.functions.pop(stmt.name.value, None)
+        if evaluator.TakesNumbers(stmt):
+          # A copy, which the generated code cache of stmt does not reach, since stmt is still to be emitted.
+          # That keeps memory use bounded when streaming, as only the functions that could be called are kept.
+          self.functions[stmt.name.value] = Rebuild(stmt, lambda node: node.Copy())
+      elif isinstance(stmt, ast.VariableDeclaration) and IsCompileTime(stmt.value):
+        try:
+          stmt = stmt.Copy(value=self.Evaluate(stmt.type, stmt.value.arguments))
+        except evaluator.EvaluationError as e:
+          raise evaluator.EvaluationError('initializer of %s: %s' % (stmt.name.value, e))
+        changed = True
+      output.append(stmt)
+    return module.Copy(statements=tuple(output)) if changed else module
+
+  def Evaluate(self, type_, arguments):
+    interpreter = evaluator.Interpreter(self.functions, self.max_steps, self.max_memory, self.max_depth)
+    dimensions, element = evaluator.Dimensions(type_)
+    if len(arguments) != 1:
+      raise evaluator.EvaluationError('%s takes one argument' % COMPILE_TIME)
+    if not dimensions:
+      try:
+        return evaluator.Literal(evaluator.Convert(interpreter.Evaluate(arguments[0], evaluator.Frame()), type_))
+      except RuntimeError:
+        # Python's own recursion limit, as in Interpreter.Call.
+        raise evaluator.EvaluationError('the expression is too deeply nested to evaluate')
+    if not isinstance(arguments[0], ast.Id):
+      raise evaluator.EvaluationError('an array is initialized with %s(f), where f is the name of a function of its indices' % COMPILE_TIME)
+    # The whole table stays in memory until it is emitted.
+    interpreter.Allocate(evaluator.Cells(dimensions))
+
+    def Table(indices):
+      if len(indices) == len(dimensions):
+        return evaluator.Literal(evaluator.Convert(interpreter.Call(arguments[0].value, indices), element))
+      return ast.InitializerList(tuple(Table(indices + [index]) for index in range(dimensions[len(indices)])))
+
+    return Table([])
+
+
+# Runtime support for Instrumenter, with %(dump)s filled in by the output format.
+INSTRUMENTATION_RUNTIME = r"""/* c4 --instrument: per-function call counts and wall-clock time, written out at exit. */
+#ifndef _POSIX_C_SOURCE
+#define _POSIX_C_SOURCE 199309L
+#endif
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#ifdef __GNUC__
+#define C4_PROFILE_UNUSED __attribute__((unused))
+#else
+#define C4_PROFILE_UNUSED
+#endif
+typedef struct c4_profile_record c4_profile_record;
+struct c4_profile_record
+{
+  const char *name;
+  unsigned long calls;
+  double seconds;
+  int depth;
+  int registered;
+  c4_profile_record *next;
+};
+static c4_profile_record *c4_profile_records = 0;
+static double c4_profile_now(void)
+{
+  struct timespec t;
+  clock_gettime(CLOCK_MONOTONIC, &t);
+  return t.tv_sec + t.tv_nsec * 1e-9;
+}
+static void c4_profile_dump(void)
+{
+  const char *path = getenv("C4_PROFILE");
+  FILE *f = fopen(path ? path : "%(default_path)s", "a");
+  c4_profile_record *r;
+  if (!f)
+    return;
+  fseek(f, 0, SEEK_END);
+%(dump)s
+  fclose(f);
+}
+static C4_PROFILE_UNUSED double c4_profile_enter(c4_profile_record *r)
+{
+  if (!r->registered)
+  {
+    if (!c4_profile_records)
+      atexit(c4_profile_dump);
+    r->registered = 1;
+    r->next = c4_profile_records;
+    c4_profile_records = r;
+  }
+  r->calls++;
+  r->depth++;
+  return c4_profile_now();
+}
+static C4_PROFILE_UNUSED void c4_profile_exit(c4_profile_record *r, double start)
+{
+  double now = c4_profile_now();
+  if (--r->depth == 0)
+    r->seconds += now - start;
+}
+"""
+
+INSTRUMENTATION_DUMPS = {
+    'csv': (
+        'c4_profile.csv',
+        '  if (ftell(f) == 0)\n'
+        '    fprintf(f, "function,calls,seconds\\n");\n'
+        '  for (r = c4_profile_records; r; r = r->next)\n'
+        '    fprintf(f, "%s,%lu,%.9f\\n", r->name, r->calls, r->seconds);',
+    ),
+    'json': (
+        'c4_profile.jsonl',
+        '  for (r = c4_profile_records; r; r = r->next)\n'
+        '    fprintf(f, "{\\"function\\": \\"%s\\", \\"calls\\": %lu, \\"seconds\\": %.9f}\\n", r->name, r->calls, r->seconds);',
+    ),
+}
+
+
+class Instrumenter(Pass):
+  """Counts the calls to every function and the wall-clock time spent in it.
+
+  Every function f gets a record, c4_profile_record_f.
+  Its body is wrapped so that entering it counts a call and reads a monotonic clock, and leaving it (through any return, or by falling off the end) adds the elapsed time to the record.
+  Times are inclusive: they include the time spent in the functions f calls.
+  Only the outermost of nested activations of a recursive function is timed, so its time is not counted more than once.
+
+  At exit, the records are appended to the file named by the C4_PROFILE environment variable (default c4_profile.csv or c4_profile.jsonl), either as CSV with a header line, or as JSON lines.
+  Appending means that several translation units, or several runs, can share one file.
+
+  Instrumenting costs two clock reads per call, so the relative overhead is largest for tiny functions called very often.
+  """
+  fusable = False
+
+  def __init__(self, format='csv'):
+    if format not in INSTRUMENTATION_DUMPS:
+      raise ValueError('Unknown instrumentation output format %s (expected one of %s)' % (format, ', '.join(sorted(INSTRUMENTATION_DUMPS))))
+    self.format = format
+
+  def Prologue(self):
+    default_path, dump = INSTRUMENTATION_DUMPS[self.format]
+    return INSTRUMENTATION_RUNTIME % {'default_path': default_path, 'dump': dump}
+
+  def Run(self, module):
+    statements = []
+    for stmt in module.statements:
+      if isinstance(stmt, ast.FunctionDefinition) and isinstance(stmt.type, ast.FunctionType):
+        name = stmt.name.value
+        record = 'c4_profile_record_' + name
+        statements.append(ast.Verbatim('static c4_profile_record %s = {"%s", 0, 0.0, 0, 0, 0};\n' % (record, name)))
+        statements.append(stmt.Copy(body=self.InstrumentBody(stmt.body, stmt.type.return_type, record)))
+      else:
+        statements.append(stmt)
+    return module.Copy(statements=tuple(statements))
+
+  def InstrumentBody(self, body, return_type, record):
+    exit_ = ast.ExpressionStatement(ast.FunctionCall(ast.Id('c4_profile_exit'), (ast.PrefixOperation('&', ast.Id(record)), ast.Id('c4_profile_start'))))
+
+    def InstrumentReturn(node):
+      if not isinstance(node, ast.Return):
+        return node
+      if return_type == ast.TypeId('void'):
+        return ast.Block((exit_, node))
+      # The return value is computed before the clock stops.
+      return ast.Block((
+          ast.VariableDeclaration(ast.Id('c4_profile_result'), return_type, node.expression),
+          exit_,
+          ast.Return(ast.Id('c4_profile_result')),
+      ))
+
+    statements = body.statements if isinstance(body, ast.Block) else (body,)
+    enter = ast.VariableDeclaration(ast.Id('c4_profile_start'), ast.TypeId('double'), ast.FunctionCall(ast.Id('c4_profile_enter'), (ast.PrefixOperation('&', ast.Id(record)),)))
+    instrumented = (enter,) + tuple(Rebuild(stmt, InstrumentReturn) for stmt in statements)
+    if not statements or not isinstance(statements[-1], ast.Return):
+      instrumented += (exit_,)
+    return ast.Block(instrumented)
+
+
+# Declaration specifiers ProfileAnnotator adds to hot and cold functions.
+HOT = 'C4_HOT'
+COLD = 'C4_COLD'
+
+# Defines HOT and COLD as gcc attributes where they are supported (gcc 4.3 and later, and clang), and as nothing otherwise, so the generated C stays valid C89.
+# Either can be overridden from the command line, e.g. -D'C4_HOT=__attribute__((hot, flatten))'.
+HOT_COLD_MACROS = """/* c4 --profile: hot and cold function attributes, where the compiler supports them. */
+#if defined(__GNUC__) && (__GNUC__ > 4 || (__GNUC__ == 4 && __GNUC_MINOR__ >= 3))
+#define C4_HAS_HOT_COLD 1
+#endif
+#ifndef C4_HOT
+#ifdef C4_HAS_HOT_COLD
+#define C4_HOT __attribute__((hot))
+#else
+#define C4_HOT
+#endif
+#endif
+#ifndef C4_COLD
+#ifdef C4_HAS_HOT_COLD
+#define C4_COLD __attribute__((cold, noinline))
+#else
+#define C4_COLD
+#endif
+#endif
+"""
+
+
+def HotFunctions(calls, hot_fraction):
+  """Returns the names of the most called functions that together account for hot_fraction of all the calls."""
+  total = sum(calls.values())
+  hot = set()
+  covered = 0
+  for name in sorted(calls, key=lambda name: (-calls[name], name)):
+    if covered >= hot_fraction * total or calls[name] == 0:
+      break
+    hot.add(name)
+    covered += calls[name]
+  return hot
+
+
+class ProfileAnnotator(Pass):
+  """Marks functions HOT or COLD according to a profile, {function name: number of calls} (see profile.py).
+
+  The most called functions that together account for hot_fraction of all the calls are hot.
+  Functions that the profile lists as never called are cold.
+  Functions that the profile does not list are left alone, so a profile of an older version of the program does no harm.
+
+  With gcc, hot functions are optimized more aggressively and cold ones for size, calls to cold functions are treated as unlikely, and from -O2 on, hot and cold functions go into text sections of their own (.text.hot and .text.unlikely), which groups the hot code together in the binary.
+  Both declarations and definitions are marked, so callers see the attribute even before the definition.
+  """
+
+  def __init__(self, calls, hot_fraction=0.9):
+    self.calls = calls
+    self.hot = HotFunctions(calls, hot_fraction)
+    self.messages = []
+    self.marked = {}
+
+  def Prologue(self):
+    return HOT_COLD_MACROS
+
+  def Begin(self, module):
+    self.messages = []
+    self.marked = {}
+
+  def End(self, module):
+    specifiers = list(self.marked.values())
+    self.messages.append('marked %d function(s) hot and %d cold' % (specifiers.count(HOT), specifiers.count(COLD)))
+
+  def Mark(self, node, name):
+    if name in self.hot:
+      self.marked[name] = HOT
+    elif self.calls.get(name) == 0:
+      self.marked[name] = COLD
+    else:
+      return
+    node.specifiers = (node.specifiers or ()) + (self.marked[name],)
+
+  def VisitFunctionDeclaration(self, node):
+    self.Mark(node, node.name)
+
+  def VisitFunctionDefinition(self, node):
+    self.Mark(node, node.name.value)
+
+
+class HotFunctionGrouper(Pass):
+  """Moves the definitions of the functions ProfileAnnotator marked to the end of the module: hot ones first, then cold ones.
+
+  This groups the hot code together in the generated C, and so also in the binary with compilers that ignore HOT and COLD, or at optimization levels that do not place them in sections of their own.
+  Each definition that moves leaves a prototype in its place, so everything that was declared before the function still is, and the function still sees everything it did.
+  Grouping needs the whole module, so it has no effect when statements are streamed one at a time.
+  """
+  requires = ('ProfileAnnotator',)
+  fusable = False
 
+  def Run(self, module):
+    statements = []
+    moved = {HOT: [], COLD: []}
+    for stmt in module.statements:
+      specifiers = (stmt.specifiers or ()) if isinstance(stmt, ast.FunctionDefinition) else ()
+      group = HOT if HOT in specifiers else COLD if COLD in specifiers else None
+      if group:
+        prototype = ast.FunctionDeclaration(stmt.name.value, stmt.type)
+        prototype.specifiers = stmt.specifiers
+        statements.append(prototype)
+        moved[group].append(stmt)
+      else:
+        statements.append(stmt)
+    return module.Copy(statements=tuple(statements + moved[HOT] + moved[COLD]))
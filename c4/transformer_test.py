@@ -0,0 +1,494 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from . import ast
+from . import parser
+from . import transformer
+
+
+class CountIds(transformer.Pass):
+
+  def __init__(self, name='CountIds', requires=()):
+    self.count = 0
+    self._name = name
+    self.requires = requires
+
+  @property
+  def name(self):
+    return self._name
+
+  def VisitId(self, node):
+    self.count += 1
+
+
+class RecordOrder(transformer.Pass):
+
+  def __init__(self):
+    self.order = []
+
+  def VisitFunctionDefinition(self, node):
+    self.order.append(node.name.value)
+
+  def VisitFunctionCall(self, node):
+    self.order.append(node.function.value + '()')
+
+
+class Rename(transformer.Pass):
+  fusable = False
+
+  def Run(self, module):
+    return ast.Module(module.statements[:1])
+
+
+MODULE = """
+    ;f f() int {
+      return g();
+    }
+    ;f g() int {
+      return h();
+    }
+"""
+
+
+class WalkTest(unittest.TestCase):
+
+  def test_parents_before_children(self):
+    self.assertEqual(
+        [type(node).__name__ for node in transformer.Walk(parser.Parse('a + b;', '<unittest>'))],
+        ['Module', 'ExpressionStatement', 'BinaryOperation', 'Id', 'Id'])
+
+
+class RebuildTest(unittest.TestCase):
+
+  def Double(self, node):
+    return ast.Int(node.value * 2) if isinstance(node, ast.Int) else node
+
+  def test_rebuild(self):
+    module = parser.Parse('f(1, x) + 2;', '<unittest>')
+    self.assertEqual(transformer.Rebuild(module, self.Double).str, 'f(2, x) + 4;\n')
+
+  def test_unchanged_nodes_are_kept(self):
+    module = parser.Parse('f(x);\ng(1);', '<unittest>')
+    new_module = transformer.Rebuild(module, self.Double)
+    self.assertIs(new_module.statements[0], module.statements[0])
+    self.assertIsNot(new_module.statements[1], module.statements[1])
+
+  def test_long_chain(self):
+    module = parser.Parse(' + '.join(['1'] * 20000) + ';', '<unittest>')
+    self.assertEqual(transformer.Rebuild(module, self.Double).str, ' + '.join(['2'] * 20000) + ';\n')
+
+
+class PassManagerTest(unittest.TestCase):
+
+  def test_independent_passes_share_a_walk(self):
+    count, order = CountIds(), RecordOrder()
+    manager = transformer.PassManager([count, order])
+    manager.Run(parser.Parse(MODULE, '<unittest>'))
+    self.assertEqual(manager.walks, [('CountIds', 'RecordOrder')])
+    self.assertEqual(count.count, 4)
+    self.assertEqual(order.order, ['f', 'g()', 'g', 'h()'])
+    self.assertEqual(manager.nodes, {'CountIds': 4, 'RecordOrder': 4})
+
+  def test_timing(self):
+    manager = transformer.PassManager([CountIds(), RecordOrder()])
+    manager.Run(parser.Parse(MODULE, '<unittest>'))
+    self.assertEqual(len(manager.walk_seconds), 1)
+    self.assertIn('visits are only timed per walk', manager.Report())
+    self.assertIn('\nCountIds, RecordOrder ', manager.Report())
+    manager = transformer.PassManager([CountIds(), RecordOrder()], time_visitors=True)
+    manager.Run(parser.Parse(MODULE, '<unittest>'))
+    self.assertEqual(manager.nodes, {'CountIds': 4, 'RecordOrder': 4})
+    self.assertNotIn('visits are only timed per walk', manager.Report())
+
+  def test_dependency_splits_walks(self):
+    manager = transformer.PassManager([CountIds('A'), RecordOrder(), CountIds('B', requires=('A',))])
+    manager.Run(parser.Parse(MODULE, '<unittest>'))
+    self.assertEqual(manager.walks, [('A', 'RecordOrder'), ('B',)])
+
+  def test_unfusable_pass_runs_alone(self):
+    manager = transformer.PassManager([CountIds('A'), Rename(), CountIds('B')])
+    module = manager.Run(parser.Parse(MODULE, '<unittest>'))
+    self.assertEqual(manager.walks, [('A',), ('Rename',), ('B',)])
+    self.assertEqual(manager.nodes, {'A': 4, 'Rename': 0, 'B': 2})
+    self.assertEqual(len(module.statements), 1)
+
+  def test_stream(self):
+    count = CountIds()
+    manager = transformer.PassManager([count, transformer.TemplateExpander()])
+    statements = list(manager.Stream(parser.Parser(MODULE + ';v xs [int]vector;', '<unittest>').Statements()))
+    self.assertEqual(count.count, 5)
+    self.assertEqual(statements[0].name, ast.Id('f'))
+    self.assertEqual(statements[-1].type, ast.TypeId('vector_int'))
+    self.assertIn(ast.Include('stdlib.h'), statements)
+
+  def test_requirement_must_run_first(self):
+    with self.assertRaises(ValueError):
+      transformer.PassManager([CountIds('B', requires=('A',)), CountIds('A')])
+
+
+STRUCTS = """
+    ;s Point {
+      ;v tag char;
+      ;v p *int;
+      ;v n short;
+    }
+    ;s Header layout_sensitive {
+      ;v tag char;
+      ;v size int;
+    }
+"""
+
+
+class StructFieldReordererTest(unittest.TestCase):
+
+  def test_struct_layout(self):
+    self.assertEqual(transformer.StructLayout([(1, 1), (8, 8), (2, 2)]), (24, 8, 13))
+    self.assertEqual(transformer.StructLayout([(8, 8), (2, 2), (1, 1)]), (16, 8, 5))
+
+  def test_array_and_nested_struct_sizes(self):
+    abi = transformer.X86_64_SYSV
+    self.assertEqual(abi.SizeAndAlignment(ast.ArrayType(ast.TypeId('short'), 3), {}), (6, 2))
+    self.assertEqual(abi.SizeAndAlignment(ast.TypeId('Point'), {'Point': (16, 8)}), (16, 8))
+    self.assertEqual(abi.SizeAndAlignment(ast.TypeId('Unknown'), {}), None)
+    self.assertEqual(transformer.I386_SYSV.SizeAndAlignment(ast.PointerType(ast.TypeId('double')), {}), (4, 4))
+
+  def test_reorder(self):
+    reorderer = transformer.StructFieldReorderer()
+    module = transformer.PassManager([reorderer]).Run(parser.Parse(STRUCTS, '<unittest>'))
+    self.assertEqual([field.name.value for field in module.statements[0].body.statements], ['p', 'n', 'tag'])
+    self.assertEqual([field.name.value for field in module.statements[1].body.statements], ['tag', 'size'])
+    self.assertEqual(reorderer.messages, ['struct Point: reordered fields, padding 13 -> 5 bytes (x86-64-sysv)'])
+
+  def test_warn_only(self):
+    reorderer = transformer.StructFieldReorderer(reorder=False, skip=('Point',))
+    module = transformer.PassManager([reorderer]).Run(parser.Parse(STRUCTS, '<unittest>'))
+    self.assertEqual([field.name.value for field in module.statements[0].body.statements], ['tag', 'p', 'n'])
+    self.assertEqual(reorderer.messages, [])
+    reorderer = transformer.StructFieldReorderer(reorder=False)
+    transformer.PassManager([reorderer]).Run(parser.Parse(STRUCTS, '<unittest>'))
+    self.assertEqual(reorderer.messages, ['struct Point wastes 13 of 24 bytes on padding, 5 with fields reordered as p, n, tag (x86-64-sysv)'])
+
+
+class TemplateExpanderTest(unittest.TestCase):
+
+  def Expand(self, string):
+    return transformer.PassManager([transformer.TemplateExpander()]).Run(parser.Parse(string, '<unittest>'))
+
+  def test_module_template(self):
+    module = self.Expand("""
+        ;t T ;s pair {
+          ;v first T;
+          ;v second T;
+        }
+        ;t T ;f pair_swap(p *[T]pair) void {
+          ;v t T = p->first;
+          p->first = p->second;
+          p->second = t;
+        }
+        ;v p [*char]pair;
+        ;v q [*char]pair;
+    """)
+    self.assertEqual(
+        [type(stmt).__name__ for stmt in module.statements],
+        ['Verbatim', 'StructDefinition', 'FunctionDeclaration', 'FunctionDefinition', 'VariableDeclaration', 'VariableDeclaration'])
+    self.assertEqual(module.statements[3].name, ast.Id('pair_ptr_char_swap'))
+    self.assertEqual(module.statements[4].type, ast.TypeId('pair_ptr_char'))
+    self.assertIn('char *first;', module.str)
+    self.assertIn('static C4_UNUSED void pair_ptr_char_swap(pair_ptr_char *p)', module.str)
+
+  def test_library_template(self):
+    module = self.Expand("""
+        ;i 'stdlib.h'
+        ;v m [int [double]vector]map;
+    """)
+    names = [stmt.name.value for stmt in module.statements if isinstance(stmt, ast.FunctionDefinition)]
+    self.assertIn('int_hash', names)
+    self.assertIn('vector_double_push', names)
+    self.assertIn('map_int_vector_double_put', names)
+    self.assertLess(names.index('vector_double_push'), names.index('map_int_vector_double_put'))
+    self.assertEqual([stmt.path for stmt in module.statements if isinstance(stmt, ast.Include)], ['stdlib.h', 'string.h'])
+    self.assertIn('  vector_double *values;\n', module.str)
+    self.assertIn('int_hash(key) & mask', module.str)
+
+  def test_hooks(self):
+    module = self.Expand("""
+        ;v T_MAX int = 8;
+        ;t T ;s set {
+          ;v items [8]T;
+        }
+        ;t T ;f set_slot(s *[T]set, item T) int {
+          return T_hash(item) % T_MAX;
+        }
+        ;v s [int]set;
+    """)
+    self.assertIn('return int_hash(item) % T_MAX;', module.str)
+    self.assertIn('int T_MAX = 8;', module.str)
+
+  def test_linkage(self):
+    program = parser.Parse(';v m [int int]map;', '<unittest>')
+    module = transformer.PassManager([transformer.TemplateExpander()]).Run(program)
+    self.assertEqual(module.statements[0], transformer.UNUSED_MACRO)
+    self.assertIn('\nstatic C4_UNUSED size_t int_hash(int key)\n', module.str)
+    self.assertIn('\nstatic C4_UNUSED void map_int_int_init(map_int_int *m);\n', module.str)
+    self.assertIn('\nstatic C4_UNUSED void map_int_int_init(map_int_int *m)\n', module.str)
+    module = transformer.PassManager([transformer.TemplateExpander(private=False)]).Run(program)
+    self.assertNotIn('static', module.str)
+    self.assertNotIn('C4_UNUSED', module.str)
+
+  def test_template_function_without_struct(self):
+    with self.assertRaises(ValueError) as context:
+      self.Expand(';t T ;f ident(a T) T { return a; } ;f main() int { return ident(0); }')
+    self.assertIn('ident', str(context.exception))
+    statements = parser.Parse(';t T ;f pair_swap(p *[T]pair) void {} ;t T ;s pair { ;v first T; }', '<unittest>').statements
+    self.assertEqual(len(list(transformer.PassManager([transformer.TemplateExpander()]).Stream(statements))), 0)
+
+  def test_unknown_template(self):
+    with self.assertRaises(ValueError):
+      self.Expand(';v x [int]nonexistent;')
+
+  def test_wrong_number_of_arguments(self):
+    with self.assertRaises(ValueError):
+      self.Expand(';v x [int]map;')
+
+
+class StructOfArraysTest(unittest.TestCase):
+
+  STRUCT = """
+      ;s Particle soa {
+        ;v x float;
+        ;v id int;
+      }
+  """
+
+  def Transform(self, string):
+    return transformer.PassManager(transformer.LanguagePasses()).Run(parser.Parse(self.STRUCT + string, '<unittest>'))
+
+  def test_generated_code(self):
+    module = self.Transform('')
+    names = [stmt.name.value for stmt in module.statements if isinstance(stmt, (ast.StructDefinition, ast.FunctionDefinition))]
+    self.assertEqual(names, [
+        'Particle', 'Particle_soa', 'Particle_soa_init', 'Particle_soa_free', 'Particle_soa_reserve',
+        'Particle_soa_resize', 'Particle_soa_get', 'Particle_soa_set', 'Particle_soa_push'])
+    self.assertIn('#include <stdlib.h>\n', module.str)
+    self.assertIn('struct Particle_soa\n{\n  float *x;\n  int *id;\n', module.str)
+    self.assertIn('v->id = realloc(v->id, capacity * sizeof(int));', module.str)
+    self.assertIn('\nstatic C4_UNUSED void Particle_soa_init(Particle_soa *v)\n', module.str)
+    module = transformer.PassManager(transformer.LanguagePasses(private=False)).Run(parser.Parse(self.STRUCT, '<unittest>'))
+    self.assertIn('\nvoid Particle_soa_init(Particle_soa *v)\n', module.str)
+    self.assertNotIn('C4_UNUSED', module.str)
+
+  def test_rewrite(self):
+    module = self.Transform("""
+        ;v global Particle_soa;
+        ;f f(ps *Particle_soa, i int) float {
+          ;v local Particle_soa;
+          global[i].x = local[i].x;
+          return ps[i].x + ps[i].id;
+        }
+    """)
+    function = module.statements[-1].Str(0)
+    self.assertIn('global.x[i] = local.x[i];', function)
+    self.assertIn('return ps->x[i] + ps->id[i];', function)
+
+  def test_shadowing(self):
+    module = self.Transform("""
+        ;v xs Particle_soa;
+        ;f f(xs *Particle, i int) float {
+          return xs[i].x;
+        }
+    """)
+    self.assertIn('return xs[i].x;', module.statements[-1].Str(0))
+
+  def test_unknown_field(self):
+    with self.assertRaises(ValueError):
+      self.Transform(';f f(ps *Particle_soa) float { return ps[0].y; }')
+
+  def test_whole_element(self):
+    with self.assertRaises(ValueError):
+      self.Transform(';f f(ps *Particle_soa) Particle { return ps[0]; }')
+
+  def test_array_field(self):
+    with self.assertRaises(ValueError):
+      transformer.PassManager(transformer.LanguagePasses()).Run(parser.Parse(';s Bad soa { ;v xs [3]int; }', '<unittest>'))
+
+
+class CompileTimeEvaluatorTest(unittest.TestCase):
+
+  def Transform(self, string):
+    return transformer.PassManager(transformer.LanguagePasses()).Run(parser.Parse(string, '<unittest>'))
+
+  def test_tables(self):
+    module = self.Transform("""
+        ;f square(i int) int { return i * i; }
+        ;f times(i int, j int) double { return i * j / 2.0; }
+        ;v squares [5]const int = compile_time(square);
+        ;v products [2][3]double = compile_time(times);
+        ;v nine long = compile_time(square(3));
+    """)
+    self.assertIn('const int squares[5] = {0, 1, 4, 9, 16};\n', module.str)
+    self.assertIn('double products[2][3] = {{0.0, 0.0, 0.0}, {0.0, 0.5, 1.0}};\n', module.str)
+    self.assertIn('long nine = 9;\n', module.str)
+    self.assertIn('int square(int i)\n', module.str)
+
+  def test_stream(self):
+    # When streaming, the functions have to be defined before they are used.
+    statements = parser.Parser(';f one(i int) int { return 1; } ;v ones [2]int = compile_time(one);', '<unittest>').Statements()
+    new_statements = list(transformer.PassManager(transformer.LanguagePasses()).Stream(statements))
+    self.assertEqual(new_statements[-1].Str(0), 'int ones[2] = {1, 1};\n')
+
+  def test_deep_expressions(self):
+    module = self.Transform(';v x long = compile_time(%s);' % ' + '.join(['1'] * 5000))
+    self.assertEqual(module.str, 'long x = 5000;\n')
+    expr = ast.Int(1)
+    for _ in range(5000):
+      expr = ast.PrefixOperation('-', expr)
+    with self.assertRaises(ValueError):
+      transformer.CompileTimeEvaluator().Evaluate(ast.TypeId('long'), (expr,))
+
+  def test_generated_code_is_released(self):
+    program = ''.join(';f f%d(i int) int { return i + %d; } ;f g%d(s *char) int { return 0; }\n' % (n, n, n) for n in range(20))
+    statements = parser.Parser(program + ';v xs [2]int = compile_time(f3);', '<unittest>').Statements()
+    evaluator_pass = transformer.CompileTimeEvaluator()
+    for stmt in transformer.PassManager([evaluator_pass]).Stream(statements):
+      stmt.Str(0)
+    self.assertEqual(stmt.Str(0), 'int xs[2] = {3, 4};\n')
+    self.assertEqual(sorted(evaluator_pass.functions), sorted('f%d' % n for n in range(20)))
+    for function in evaluator_pass.functions.values():
+      self.assertFalse(any('_emitted' in node.__dict__ for node in transformer.Walk(function)))
+
+  def test_matches_gcc(self):
+    # The table is computed by the transpiler, the second column by the compiled program.
+    module = self.Transform("""
+        ;i 'stdio.h'
+        ;i 'stdint.h'
+        ;f mix(i int) uint32_t {
+          ;v h uint32_t = i * 2654435761;
+          ;v small uint8_t = h;
+          ;v x uint32_t = (h * 40503) >> 28;
+          x ^= ~h >> 28;
+          x += (h - 4000000000) / 3 + -h % 7 + (h < -1) + (~small >> 3);
+          x = x * 31 + (i & 1 ? -i : h) + ((x << 7) | (x >> 25));
+          return x;
+        }
+        ;v table [64]uint32_t = compile_time(mix);
+        ;f main() int {
+          ;v i int = 0;
+          while i < 64 {
+            ;v expected size_t = table[i];
+            ;v actual size_t = mix(i);
+            printf("%lu %lu\\n", expected, actual);
+            i++;
+          }
+          return 0;
+        }
+    """)
+    directory = tempfile.mkdtemp()
+    try:
+      source = os.path.join(directory, 'mix.c')
+      with open(source, 'w') as f:
+        f.write(module.str)
+      try:
+        subprocess.check_call(['gcc', '-o', os.path.join(directory, 'mix'), source])
+      except OSError:
+        self.skipTest('gcc is not available')
+      output = subprocess.check_output([os.path.join(directory, 'mix')]).decode()
+    finally:
+      shutil.rmtree(directory)
+    rows = [line.split() for line in output.splitlines()]
+    self.assertEqual(len(rows), 64)
+    for expected, actual in rows:
+      self.assertEqual(expected, actual)
+    self.assertGreater(len(set(row[0] for row in rows)), 60)
+
+  def test_errors(self):
+    with self.assertRaises(ValueError):
+      self.Transform(';v xs [2]int = compile_time(undefined);')
+    with self.assertRaises(ValueError):
+      self.Transform(';f f(i int) int { return 0; } ;v xs [2]int = compile_time(f(1));')
+    with self.assertRaises(ValueError):
+      self.Transform(';f f(i int) int { return 1; } ;v xs [2000000]int = compile_time(f);')
+
+
+class InstrumenterTest(unittest.TestCase):
+
+  def Instrument(self, string, format='csv'):
+    manager = transformer.PassManager([transformer.Instrumenter(format)])
+    return manager, manager.Run(parser.Parse(string, '<test>'))
+
+  def test_every_exit_is_timed(self):
+    _, module = self.Instrument("""
+        ;f sign(x int) int {
+          if (x < 0) {
+            return -1;
+          }
+          return x > 0;
+        }
+    """)
+    self.assertEqual(
+        [type(stmt).__name__ for stmt in module.statements],
+        ['Verbatim', 'FunctionDefinition'])
+    self.assertIn('static c4_profile_record c4_profile_record_sign = {"sign",', module.str)
+    body = module.statements[1].body.Str(0)
+    self.assertTrue(body.startswith('{\n  double c4_profile_start = c4_profile_enter(&c4_profile_record_sign);\n'))
+    self.assertEqual(body.count('c4_profile_exit(&c4_profile_record_sign, c4_profile_start);'), 2)
+    self.assertIn('int c4_profile_result = -1;', body)
+
+  def test_falling_off_the_end(self):
+    _, module = self.Instrument(';f hello() void { puts("hello"); }')
+    self.assertTrue(module.statements[1].body.Str(0).endswith(
+        '  c4_profile_exit(&c4_profile_record_hello, c4_profile_start);\n}\n'))
+
+  def test_prologue(self):
+    manager, _ = self.Instrument(';f f() int { return 0; }', 'json')
+    self.assertTrue(manager.Prologue().startswith('/* c4 --instrument'))
+    self.assertIn('c4_profile.jsonl', manager.Prologue())
+    self.assertNotIn('%(', manager.Prologue())
+
+  def test_unknown_format(self):
+    with self.assertRaises(ValueError):
+      transformer.Instrumenter('xml')
+
+
+class ProfileAnnotatorTest(unittest.TestCase):
+
+  PROGRAM = """
+      ;f fail(message *char) int { return puts(message); }
+      ;f step(x int) int { return x + 1; }
+      ;f main(argc int, argv **char) int { return step(0); }
+  """
+
+  def test_hot_functions(self):
+    calls = {'a': 90, 'b': 6, 'c': 4, 'd': 0}
+    self.assertEqual(transformer.HotFunctions(calls, 0.9), set(['a']))
+    self.assertEqual(transformer.HotFunctions(calls, 0.95), set(['a', 'b']))
+    self.assertEqual(transformer.HotFunctions({'d': 0}, 0.9), set())
+
+  def test_annotate(self):
+    annotator = transformer.ProfileAnnotator({'fail': 0, 'step': 100, 'main': 1})
+    module = transformer.PassManager([annotator]).Run(parser.Parse(self.PROGRAM, '<test>'))
+    self.assertEqual([stmt.specifiers for stmt in module.statements], [(transformer.COLD,), (transformer.HOT,), None])
+    self.assertIn('C4_COLD int fail(char *message)\n', module.str)
+    self.assertIn('C4_HOT int step(int x)\n', module.str)
+    self.assertIn('\nint main(int argc, char **argv)\n', module.str)
+    self.assertEqual(annotator.messages, ['marked 1 function(s) hot and 1 cold'])
+    self.assertIn('#define C4_COLD __attribute__((cold, noinline))', annotator.Prologue())
+
+  def test_group(self):
+    passes = [transformer.ProfileAnnotator({'fail': 0, 'step': 100, 'main': 1}), transformer.HotFunctionGrouper()]
+    module = transformer.PassManager(passes).Run(parser.Parse(self.PROGRAM, '<test>'))
+    self.assertEqual(
+        [(type(stmt).__name__, stmt.specifiers) for stmt in module.statements],
+        [
+            ('FunctionDeclaration', (transformer.COLD,)),
+            ('FunctionDeclaration', (transformer.HOT,)),
+            ('FunctionDefinition', None),
+            ('FunctionDefinition', (transformer.HOT,)),
+            ('FunctionDefinition', (transformer.COLD,)),
+        ])
+
+
+if __name__ == '__main__':
+  unittest.main()
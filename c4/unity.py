@@ -0,0 +1,136 @@
+"""unity.py
+
+Unity builds: translating many c4 modules into one (or a few) C translation units.
+
+Every .c4 file normally becomes a .c file of its own, and every one of those includes the same system headers, so gcc parses them over and over.
+A unity build puts the modules together instead, so each header is parsed once per translation unit:
+
+  1. all the modules go through one PassManager, so a template instance used by several modules is generated only once,
+  2. the includes of all the modules are deduplicated and go first,
+  3. then the struct definitions (identical definitions repeated in several modules are kept once),
+  4. then a prototype for every function and an extern declaration of every global variable, so functions may use them regardless of which module defines them,
+  5. and then, batch by batch, the global variables and function definitions of each module.
+
+With more than one batch, the modules are spread over the batches by size, so they can be compiled in parallel.
+Steps 2-4 are the same for every batch. They can instead go into a shared header, which is a good candidate for a precompiled header.
+"""
+from . import ast
+from . import parser
+from . import transformer
+
+UNITY_BANNER = "/* THIS FILE WAS AUTOGENERATED FROM %s USING THE C4 TRANSPILER */\n"
+
+
+def Batches(sizes, count):
+  """Splits modules with the given sizes into at most count batches of roughly equal total size.
+
+  Returns a list of lists of module indices, each in the original order.
+  """
+  if count < 1:
+    raise ValueError('the number of batches must be at least 1, not %d' % count)
+  batches = [[] for _ in range(min(count, len(sizes)))]
+  totals = [0] * len(batches)
+  for index in sorted(range(len(sizes)), key=lambda index: -sizes[index]):
+    smallest = totals.index(min(totals))
+    batches[smallest].append(index)
+    totals[smallest] += sizes[index]
+  return [sorted(batch) for batch in batches if batch]
+
+
+def HeaderGuard(name):
+  return ''.join(c.upper() if c.isalnum() else '_' for c in name)
+
+
+class Unity(object):
+  """Translates modules, given as (source, string) pairs, into batched translation units.
+
+  With time_visitors, manager times every visit of every pass (see PassManager).
+  After Translate, manager holds the PassManager, prologue holds the code the passes need at the very top of every translation unit, header holds the shared declarations (steps 2-4 of the module docstring) and definitions holds, for each module, its global variables and function definitions.
+  """
+
+  def __init__(self, passes=(), time_visitors=False):
+    self.passes = list(passes)
+    self.time_visitors = time_visitors
+
+  def Translate(self, modules):
+    self.includes = []
+    self.structs = {}
+    self.declarations = []
+    self.prototypes = {}
+    self.globals = {}
+    self.definitions = []
+    # The shared header declares the functions generated for templates, so that all batches use the same copy, which therefore has external linkage.
+    manager = self.manager = transformer.PassManager(transformer.LanguagePasses(private=False) + self.passes, self.time_visitors)
+    self.prologue = manager.Prologue()
+    manager.Begin(None)
+    for source, string in modules:
+      definitions = []
+      for stmt in parser.Parser(string, source).Statements():
+        for new_stmt in manager.RunGroups(ast.Module((stmt,))).statements:
+          self.Add(new_stmt, definitions)
+      self.definitions.append(definitions)
+    manager.End(None)
+
+  def Add(self, stmt, definitions):
+    if isinstance(stmt, ast.Include):
+      if stmt not in self.includes:
+        self.includes.append(stmt)
+    elif isinstance(stmt, ast.StructDefinition):
+      name = stmt.name.value
+      if name not in self.structs:
+        self.structs[name] = stmt
+        self.declarations.append(stmt)
+      elif self.structs[name] != stmt:
+        raise ValueError('struct %s is defined differently in different modules' % name)
+    elif isinstance(stmt, (ast.FunctionDeclaration, ast.FunctionDefinition)):
+      name = stmt.name if isinstance(stmt, ast.FunctionDeclaration) else stmt.name.value
+      if name not in self.prototypes:
+        self.prototypes[name] = ast.FunctionDeclaration(name, stmt.type)
+        self.prototypes[name].specifiers = stmt.specifiers
+        self.declarations.append(self.prototypes[name])
+      if isinstance(stmt, ast.FunctionDefinition):
+        definitions.append(stmt)
+    elif isinstance(stmt, ast.VariableDeclaration):
+      name = stmt.name.value
+      declaration = ast.Verbatim('extern ' + stmt.Copy(value=None).Str(0))
+      if name not in self.globals:
+        self.globals[name] = declaration
+        self.declarations.append(declaration)
+      elif self.globals[name] != declaration:
+        raise ValueError('global variable %s is declared differently in different modules' % name)
+      definitions.append(stmt)
+    else:
+      definitions.append(stmt)
+
+  @property
+  def header(self):
+    return ''.join(stmt.Str(0) for stmt in self.includes + self.declarations)
+
+  def Batch(self, indices):
+    return ''.join(stmt.Str(0) for index in indices for stmt in self.definitions[index])
+
+
+def TranslateUnity(modules, passes=(), batches=1, header_name=None, report=None):
+  """Translates modules, a list of (source, string) pairs, into at most 'batches' C translation units.
+
+  Returns (header, units): units is a list of C programs.
+  If header_name is given, header is the text of the shared header and every unit includes it by that name; otherwise header is None and every unit starts with the shared declarations.
+  If report is a file, the time spent in every pass is written to it.
+  """
+  unity = Unity(passes, time_visitors=report is not None)
+  unity.Translate(modules)
+  if report is not None:
+    report.write(unity.manager.Report())
+  groups = Batches([len(string) for _, string in modules], batches)
+  shared = unity.header
+  header = None
+  if header_name is not None:
+    guard = HeaderGuard(header_name)
+    header = (UNITY_BANNER % ', '.join(source for source, _ in modules) +
+              '#ifndef %s\n#define %s\n' % (guard, guard) + unity.prologue + shared + '#endif\n')
+  units = []
+  for group in groups:
+    banner = UNITY_BANNER % ', '.join(modules[index][0] for index in group)
+    prologue = '#include "%s"\n' % header_name if header_name is not None else unity.prologue + shared
+    units.append(banner + prologue + unity.Batch(group))
+  return header, units
@@ -0,0 +1,79 @@
+import unittest
+
+from . import unity
+
+A = """
+    ;i 'stdio.h'
+    ;s Point {
+      ;v x int;
+    }
+    ;f a(p *Point) int {
+      return b(p->x);
+    }
+"""
+
+B = """
+    ;i 'stdio.h'
+    ;i 'stdlib.h'
+    ;s Point {
+      ;v x int;
+    }
+    ;v xs [int]vector;
+    ;f b(x int) int {
+      return x;
+    }
+"""
+
+
+class UnityTest(unittest.TestCase):
+
+  def test_single_unit(self):
+    header, units = unity.TranslateUnity([('a.c4', A), ('b.c4', B)])
+    self.assertIsNone(header)
+    self.assertEqual(len(units), 1)
+    unit = units[0]
+    self.assertEqual(unit.count('#include <stdio.h>'), 1)
+    self.assertEqual(unit.count('struct Point\n'), 1)
+    # Every prototype comes before any definition, so a may call b.
+    self.assertLess(unit.index('int b(int x);'), unit.index('int a(Point *p)\n'))
+    self.assertLess(unit.index('#include <stdlib.h>'), unit.index('struct Point\n'))
+
+  def test_batches_with_header(self):
+    header, units = unity.TranslateUnity([('a.c4', A), ('b.c4', B), ('c.c4', '')], batches=2, header_name='common.h')
+    self.assertIn('#ifndef COMMON_H\n', header)
+    self.assertIn('void vector_int_push(vector_int *v, int value);\n', header)
+    self.assertEqual(len(units), 2)
+    for unit in units:
+      self.assertIn('#include "common.h"\n', unit)
+      self.assertNotIn('#include <stdio.h>', unit)
+    self.assertEqual(sum(unit.count('void vector_int_push(vector_int *v, int value)\n{') for unit in units), 1)
+
+  def test_globals(self):
+    modules = [('a.c4', ';f next() int { return counter++; }'), ('b.c4', ';v counter int = 0;\n;v table [4]const long;')]
+    header, units = unity.TranslateUnity(modules)
+    unit = units[0]
+    self.assertIn('extern int counter;\n', unit)
+    self.assertIn('extern const long table[4];\n', unit)
+    self.assertLess(unit.index('extern int counter;'), unit.index('int next()\n'))
+    self.assertEqual(unit.count('int counter = 0;\n'), 1)
+    header, units = unity.TranslateUnity(modules, batches=2, header_name='common.h')
+    self.assertIn('extern int counter;\n', header)
+    self.assertEqual(sum(unit.count('int counter = 0;\n') for unit in units), 1)
+
+  def test_conflicting_globals(self):
+    with self.assertRaises(ValueError):
+      unity.TranslateUnity([('a.c4', ';v x int;'), ('b.c4', ';v x long;')])
+
+  def test_conflicting_structs(self):
+    with self.assertRaises(ValueError):
+      unity.TranslateUnity([('a.c4', A), ('c.c4', ';s Point { ;v y int; }')])
+
+  def test_batches(self):
+    self.assertEqual(unity.Batches([1, 10, 2, 9], 2), [[0, 1], [2, 3]])
+    self.assertEqual(unity.Batches([5], 3), [[0]])
+    with self.assertRaises(ValueError):
+      unity.Batches([5], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
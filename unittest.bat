@@ -1 +1 @@
-python -m unittest -v c4.ast_test c4.parser_test
+python -m unittest -v c4.ast_test c4.benchmark_test c4.evaluator_test c4.parser_test c4.profile_test c4.transformer_test c4.unity_test